@@ -500,10 +500,15 @@ class InferenceDataProcessorLL(InferenceDataProcessor):
 
         context, continuation = request
 
-        ## Step 1: Tokenize request
-        context_enc, continuation_enc = _encode_pair(
-            context, continuation, tokenizer, tokenizer.eos_token_id
-        )
+        ## Step 1: Tokenize request. Windows of rolling loglikelihood
+        ## requests are already tokenized
+        is_window = not isinstance(context, str)
+        if is_window:
+            context_enc, continuation_enc = list(context), list(continuation)
+        else:
+            context_enc, continuation_enc = _encode_pair(
+                context, continuation, tokenizer, tokenizer.eos_token_id
+            )
 
         # FROM EEH script:
         # https://github.com/EleutherAI/lm-evaluation-harness/blob/c9bbec6e7de418b9082379da82797522eb173054/lm_eval/models/huggingface.py#L706-L709
@@ -513,33 +518,46 @@ class InferenceDataProcessorLL(InferenceDataProcessor):
         if not len(continuation_enc) > 0:
             raise RuntimeError(f"Failed to tokenize input `{continuation}`")
 
-        # Hard failure similar to EEH's assertion below:
-        # assert len(continuation_enc) <= self.max_length
-        # if samples' context cannot be captured
-        # Subtracting 1 from msl to account for EOS token at
-        # the end of the input
-        if len(continuation_enc) >= max_sequence_length - 1:
-            raise RuntimeError(
-                f"Continuation enconding length {len(continuation_enc)} "
-                f"is longer than msl of {max_sequence_length}. Please choose "
-                "a larger msl or consider skipping eval for this task."
-            )
+        if is_window:
+            # Rolling windows are sized like in EEH, where all but the last
+            # token of the window are inputs, so they may fill the whole msl
+            window_len = len(context_enc) + len(continuation_enc) - 1
+            if window_len > max_sequence_length:
+                raise RuntimeError(
+                    f"Rolling window of {window_len} input tokens is longer "
+                    f"than msl of {max_sequence_length}."
+                )
+        else:
+            # Hard failure similar to EEH's assertion below:
+            # assert len(continuation_enc) <= self.max_length
+            # if samples' context cannot be captured
+            # Subtracting 1 from msl to account for EOS token at
+            # the end of the input
+            if len(continuation_enc) >= max_sequence_length - 1:
+                raise RuntimeError(
+                    f"Continuation enconding length {len(continuation_enc)} "
+                    f"is longer than msl of {max_sequence_length}. Please choose "
+                    "a larger msl or consider skipping eval for this task."
+                )
 
-        # Truncate context from the left if the input (context_enc + cont_enc) len
-        # exceeds maximum sequence length
-        if len(context_enc) + len(continuation_enc) >= max_sequence_length:
-            context_enc = context_enc[
-                -(max_sequence_length - 1 - len(continuation_enc)) :
-            ]
+            # Truncate context from the left if the input (context_enc + cont_enc) len
+            # exceeds maximum sequence length
+            if len(context_enc) + len(continuation_enc) >= max_sequence_length:
+                context_enc = context_enc[
+                    -(max_sequence_length - 1 - len(continuation_enc)) :
+                ]
 
         ## Step 2: Preprocess tokenized requests to create data samples
         # Cast the requests to this format [(input_ids, continuation_ids, mask, labels)]
         sample = np.array((context_enc + continuation_enc), dtype=np.int32)
-        input_len = len(sample)
+        num_inputs = len(sample) - 1
+        # The last token of a window is only used as a label. Other samples
+        # keep a trailing position whose label is the EOS token
+        input_len = num_inputs if is_window else len(sample)
 
         # Input ids
         input_ids = np.zeros(input_len, dtype=np.int32)
-        input_ids[:-1] = sample[:-1]
+        input_ids[:num_inputs] = sample[:-1]
 
         # Continutation ids
         cont_ids = np.zeros(input_len, dtype=np.int32)
@@ -555,8 +573,9 @@ class InferenceDataProcessorLL(InferenceDataProcessor):
 
         # Label ids
         label_ids = np.zeros(input_len, dtype=np.int32)
-        label_ids[:-1] = sample[1:]
-        label_ids[-1] = tokenizer.eos_token_id
+        label_ids[:num_inputs] = sample[1:]
+        if not is_window:
+            label_ids[-1] = tokenizer.eos_token_id
 
         sample_full = [
             input_ids,
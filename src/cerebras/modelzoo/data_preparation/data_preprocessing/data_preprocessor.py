@@ -28,6 +28,8 @@ import sys
 import time
 import traceback
 from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
 from multiprocessing import Lock, Pool, Process, Queue, Value, cpu_count
 from threading import Event, Thread
@@ -79,6 +81,11 @@ logging.basicConfig()
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.INFO)
 
+## Maximum number of output HDF5 files a writer keeps open while shuffling.
+MAX_OPEN_H5_FILES = 64
+## Number of threads used to stat the input files.
+STAT_THREADS = 32
+
 
 def get_available_memory():
     """
@@ -558,6 +565,26 @@ class DataPreprocessor:
 
         logger.info(f"\nChunk size : {formatted_max_chunk_size}.\n")
         self.write_in_batch = processing_params.pop("write_in_batch", False)
+        ## Compression filter for the output HDF5 files. Compression is CPU
+        ## bound and can throttle the writers on fast local storage, so it can
+        ## be disabled with `null` (or switched to a cheaper filter like "lzf")
+        ## at the cost of larger output files.
+        self.compression = processing_params.pop("compression", "gzip")
+        ## number of chunks written between two checkpoint updates
+        self.checkpoint_interval = max(
+            1, processing_params.pop("checkpoint_interval", 1)
+        )
+        ## Shuffled writers append every chunk to shared output files, so
+        ## chunks written after the last checkpoint would be appended a
+        ## second time when resuming
+        if self.checkpoint_interval > 1 and processing_params.get(
+            "shuffle", False
+        ):
+            raise ValueError(
+                "`checkpoint_interval` greater than 1 is not supported with "
+                "`shuffle`, since resuming would duplicate the chunks written "
+                "after the last checkpoint."
+            )
         self.read_hook_path = processing_params.pop("read_hook", None)
         self.read_hook_kwargs = processing_params.pop("read_hook_kwargs", None)
         if not self.read_hook_path:
@@ -843,6 +870,11 @@ class DataPreprocessor:
         self.n_examples = (
             0  ## stores the total number of sequences in the current dataset
         )
+        ## LRU of HDF5 handles kept open by a writer that exclusively owns
+        ## the shuffled output files
+        self._open_h5_files = OrderedDict()
+        ## HDF5 dtype used for each data label, resolved on first write
+        self._h5_dtype_cache = {}
 
     def get_params_file(self) -> str:
         """
@@ -870,10 +902,14 @@ class DataPreprocessor:
         Returns:
             int: The total size of all input files in bytes.
         """
-        total_size = sum(
-            os.path.getsize(file) * get_compression_factor(file)
-            for file in self.input_files
-        )
+        # `stat` calls are latency bound on network file systems, so issue
+        # them concurrently rather than one file at a time.
+        with ThreadPoolExecutor(max_workers=STAT_THREADS) as executor:
+            file_sizes = executor.map(os.path.getsize, self.input_files)
+            total_size = sum(
+                file_size * get_compression_factor(file)
+                for file, file_size in zip(self.input_files, file_sizes)
+            )
         return total_size
 
     def human_readable_size(self, size, decimal_places=2):
@@ -1040,7 +1076,10 @@ class DataPreprocessor:
 
                             with h5py.File(output_file_name, "w") as h5f:
                                 self.save_buffer_to_hdf5(
-                                    h5f, buffer, self.write_in_batch
+                                    h5f,
+                                    buffer,
+                                    self.write_in_batch,
+                                    compression=self.compression,
                                 )
                                 self.final_data_stats["examples"].value += int(
                                     h5f.attrs["n_examples"]
@@ -1050,6 +1089,7 @@ class DataPreprocessor:
                                 df_chunk,
                                 self.output_dir,
                                 chunk_locks,
+                                compression=self.compression,
                             )
 
                             self.final_data_stats[
@@ -1060,6 +1100,8 @@ class DataPreprocessor:
                 logger.error(
                     f"Exception in write_remaining_prefix: \n {traceback.format_exc()}",
                 )
+            finally:
+                self.close_h5_files()
 
     @staticmethod
     def shuffle_single_file(args):
@@ -1179,7 +1221,10 @@ class DataPreprocessor:
             process_stats_path = root + f'_process_stats_{process_idx}.json'
 
             buffer = {}
+            buffer_bytes = 0
             cum_size = 0
+            pending_checkpoint = None
+            chunks_since_checkpoint = 0
             process_data_stats = defaultdict(int)
             for df_chunk in reader.stream_data(checkpoint_args):
                 # Tokenize chunk
@@ -1208,14 +1253,18 @@ class DataPreprocessor:
                         if data_label not in buffer:
                             buffer[data_label] = []
                         buffer[data_label].append(data)
-                    if get_size(buffer) >= self.write_chunk_size:
+                        buffer_bytes += data.nbytes
+                    if buffer_bytes >= self.write_chunk_size:
                         output_file_name = os.path.join(
                             self.output_dir,
                             f"output_chunk_{process_idx}_{df_chunk.file_idx}_{df_chunk.start_doc_idx}_{process_chunk_number}.h5",
                         )
                         with h5py.File(output_file_name, "w") as h5f:
                             self.save_buffer_to_hdf5(
-                                h5f, buffer, self.write_in_batch
+                                h5f,
+                                buffer,
+                                self.write_in_batch,
+                                compression=self.compression,
                             )
                             self.final_data_stats["examples"].value += int(
                                 h5f.attrs["n_examples"]
@@ -1225,11 +1274,13 @@ class DataPreprocessor:
                             )
                         num_chunks_written += 1
                         buffer = {}
+                        buffer_bytes = 0
                 else:
                     n_examples = self.append_df_to_hdf5(
                         df_chunk,
                         self.output_dir,
                         chunk_locks,
+                        compression=self.compression,
                     )
                     self.final_data_stats["examples"].value += n_examples
                     process_data_stats["examples"] += n_examples
@@ -1241,21 +1292,32 @@ class DataPreprocessor:
 
                 progress_counter.value += 1
                 process_chunk_number += 1
-                checkpoint_data = [
+                pending_checkpoint = [
                     df_chunk.file_idx,
                     checkpoint_doc_idx,
                     process_chunk_number,
                     num_chunks_written,
                     0,
                 ]
-                self.update_checkpoint(process_checkpoint_path, checkpoint_data)
+                chunks_since_checkpoint += 1
+                if chunks_since_checkpoint >= self.checkpoint_interval:
+                    self.update_checkpoint(
+                        process_checkpoint_path, pending_checkpoint
+                    )
+                    pending_checkpoint = None
+                    chunks_since_checkpoint = 0
             if len(buffer) > 0:
                 output_file_name = os.path.join(
                     self.output_dir,
                     f"output_chunk_{process_idx}_{df_chunk.file_idx}_{df_chunk.start_doc_idx}_{process_chunk_number}.h5",
                 )
                 with h5py.File(output_file_name, "w") as h5f:
-                    self.save_buffer_to_hdf5(h5f, buffer, self.write_in_batch)
+                    self.save_buffer_to_hdf5(
+                        h5f,
+                        buffer,
+                        self.write_in_batch,
+                        compression=self.compression,
+                    )
                     self.final_data_stats["examples"].value += int(
                         h5f.attrs["n_examples"]
                     )
@@ -1271,6 +1333,10 @@ class DataPreprocessor:
                     0,
                 ]
                 self.update_checkpoint(process_checkpoint_path, checkpoint_data)
+            elif pending_checkpoint is not None:
+                self.update_checkpoint(
+                    process_checkpoint_path, pending_checkpoint
+                )
 
             dump_args(process_data_stats, process_stats_path)
 
@@ -1288,6 +1354,8 @@ class DataPreprocessor:
             logger.error(
                 f"Exception in process_files: \n {traceback.format_exc()}",
             )
+        finally:
+            self.close_h5_files()
 
     def file_split_process_dataset(self) -> None:
         """
@@ -1524,8 +1592,22 @@ class DataPreprocessor:
         if self.shuffle:
             np.random.seed(self.shuffle_seed + writer_idx)
 
+        # These are invariant over the lifetime of the writer, so resolve
+        # them once instead of on every chunk.
+        is_vsl = isinstance(
+            self.token_generator,
+            (VSLPretrainingTokenGenerator, VSLFinetuningTokenGenerator),
+        )
+        shuffle = self.shuffle
+        output_dir = self.output_dir
+        write_in_batch = self.write_in_batch
+        compression = self.compression
+
         buffer = {}
+        buffer_bytes = 0
         cum_size = 0
+        pending_checkpoint = None
+        chunks_since_checkpoint = 0
         try:
             while True:
                 chunk_data = self.writer_queues[tokenizer_idx].get()
@@ -1551,30 +1633,30 @@ class DataPreprocessor:
                     progress_counter.value += 1
                     continue
                 else:
-                    checkpoint_doc_idx = df_chunk.end_doc_idx + 1
-                    if isinstance(
-                        self.token_generator,
-                        (
-                            VSLPretrainingTokenGenerator,
-                            VSLFinetuningTokenGenerator,
-                        ),
-                    ):
-                        checkpoint_doc_idx = df_chunk.start_doc_idx
-                    if not self.shuffle:
+                    checkpoint_doc_idx = (
+                        df_chunk.start_doc_idx
+                        if is_vsl
+                        else df_chunk.end_doc_idx + 1
+                    )
+                    if not shuffle:
                         for data_label, data in df_chunk.tokenized_data.items():
                             data = np.concatenate(data, axis=0)
                             if data_label not in buffer:
                                 buffer[data_label] = []
                             buffer[data_label].append(data)
-                        if get_size(buffer) >= self.write_chunk_size:
+                            buffer_bytes += data.nbytes
+                        if buffer_bytes >= self.write_chunk_size:
                             output_file_name = os.path.join(
-                                self.output_dir,
+                                output_dir,
                                 f"output_chunk_{writer_idx}_{df_chunk.file_idx}_{df_chunk.start_doc_idx}_{chunk_number}.h5",
                             )
 
                             with h5py.File(output_file_name, "w") as h5f:
                                 self.save_buffer_to_hdf5(
-                                    h5f, buffer, self.write_in_batch
+                                    h5f,
+                                    buffer,
+                                    write_in_batch,
+                                    compression=compression,
                                 )
                                 self.final_data_stats["examples"].value += int(
                                     h5f.attrs["n_examples"]
@@ -1584,11 +1666,13 @@ class DataPreprocessor:
                                 )
                             num_chunks_written += 1
                             buffer = {}
+                            buffer_bytes = 0
                     else:
                         n_examples = self.append_df_to_hdf5(
                             df_chunk,
-                            self.output_dir,
+                            output_dir,
                             chunk_locks,
+                            compression=compression,
                         )
                         self.final_data_stats["examples"].value += n_examples
                         process_data_stats["examples"] += n_examples
@@ -1598,24 +1682,30 @@ class DataPreprocessor:
                             cum_size = 0
                     df_chunk.tokenized_data.clear()
                     progress_counter.value += 1
-                    checkpoint_data = [
+                    pending_checkpoint = [
                         df_chunk.file_idx,
                         checkpoint_doc_idx,
                         chunk_number + 1,
                         num_chunks_written,
                         0,
                     ]
-                    self.update_checkpoint(
-                        process_checkpoint_path, checkpoint_data
-                    )
+                    chunks_since_checkpoint += 1
+                    if chunks_since_checkpoint >= self.checkpoint_interval:
+                        self.update_checkpoint(
+                            process_checkpoint_path, pending_checkpoint
+                        )
+                        pending_checkpoint = None
+                        chunks_since_checkpoint = 0
 
             if len(buffer) > 0:
                 output_file_name = os.path.join(
-                    self.output_dir,
+                    output_dir,
                     f"output_chunk_remaining_{df_chunk.file_idx}_{df_chunk.start_doc_idx}.h5",
                 )
                 with h5py.File(output_file_name, "w") as h5f:
-                    self.save_buffer_to_hdf5(h5f, buffer, self.write_in_batch)
+                    self.save_buffer_to_hdf5(
+                        h5f, buffer, write_in_batch, compression=compression
+                    )
                     self.final_data_stats["examples"].value += int(
                         h5f.attrs["n_examples"]
                     )
@@ -1631,12 +1721,18 @@ class DataPreprocessor:
                     0,
                 ]
                 self.update_checkpoint(process_checkpoint_path, checkpoint_data)
+            elif pending_checkpoint is not None:
+                self.update_checkpoint(
+                    process_checkpoint_path, pending_checkpoint
+                )
 
             dump_args(process_data_stats, process_stats_path)
         except Exception as e:
             logger.error(
                 f"Exception in writer process {os.getpid()}: \n {traceback.format_exc()}",
             )
+        finally:
+            self.close_h5_files()
 
     def task_split_process_dataset(self) -> None:
         """
@@ -1726,9 +1822,11 @@ class DataPreprocessor:
                 # join. We need to figure out a better
                 # solution.
                 t.join(timeout=1e-6)
-            self.write_remaining_prefix(chunk_locks, self.writer_process_num)
+            ## Writers must be done with the output files before the
+            ## remaining prefix is appended to them.
             for w in writers:
                 w.join()
+            self.write_remaining_prefix(chunk_locks, self.writer_process_num)
 
             # Final update of the progress bar to make sure it reaches `progress_counter.value`
             pbar.n = progress_counter.value
@@ -1796,18 +1894,29 @@ class DataPreprocessor:
         """
         return len(self.tokenizer)
 
+    def get_h5_dtype(self, data_label, data_dtype):
+        """
+        Return the HDF5 dtype to store `data_label` with. The answer only
+        depends on the label, so it is computed once and cached.
+        """
+        dtype = self._h5_dtype_cache.get(data_label)
+        if dtype is None:
+            if data_dtype.kind == 'S':
+                dtype = h5py.string_dtype(encoding='utf-8')
+            elif data_dtype == np.bool_:
+                dtype = np.bool_
+            else:
+                dtype = "i4"
+            self._h5_dtype_cache[data_label] = dtype
+        return dtype
+
     def save_buffer_to_hdf5(
         self, h5file, buffer, write_in_batch, dtype="i4", compression="gzip"
     ):
         n_examples = 0
         for data_label in [*buffer]:
             data = np.concatenate(buffer[data_label], axis=0)
-            if data.dtype.kind == 'S':
-                dtype = h5py.string_dtype(encoding='utf-8')
-            elif data.dtype == np.bool_:
-                dtype = np.bool_
-            else:
-                dtype = "i4"
+            dtype = self.get_h5_dtype(data_label, data.dtype)
             if len(data.shape) > 1:
                 chunks_shape = (
                     1,
@@ -1857,14 +1966,22 @@ class DataPreprocessor:
             np.arange(self.total_output_files), n_examples
         )
 
-        # Step 3: Group indices per output file
-        idx_seq_to_indices = defaultdict(list)
-        for idx, idx_seq in enumerate(shuffled_indices):
-            idx_seq_to_indices[idx_seq].append(idx)
+        # Step 3: Group examples per output file. A single stable sort by
+        # destination lays out each file's examples contiguously (in their
+        # original order), so every label is gathered exactly once and each
+        # file receives a plain slice instead of a fancy-indexed copy.
+        order = np.argsort(shuffled_indices, kind="stable")
+        counts = np.bincount(
+            shuffled_indices, minlength=self.total_output_files
+        )
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        sorted_data_dict = {
+            data_label: data[order] for data_label, data in data_dict.items()
+        }
 
         # Step 4: Write data to HDF5 files in batches
-        for idx_seq, indices in idx_seq_to_indices.items():
-            indices = np.array(indices)
+        for idx_seq in np.flatnonzero(counts):
+            start, end = offsets[idx_seq], offsets[idx_seq + 1]
             output_file_name = os.path.join(
                 output_dir, f"output_chunk_{idx_seq}.h5"
             )
@@ -1873,28 +1990,23 @@ class DataPreprocessor:
             )
 
             with optional_lock(lock):
-                with h5py.File(output_file_name, "a") as h5f:
+                with self.open_h5_file(
+                    output_file_name, exclusive=chunk_locks is None
+                ) as h5f:
                     # Initialize or update n_examples attribute
                     if 'n_examples' in h5f.attrs:
                         old_n_examples = h5f.attrs['n_examples']
                     else:
                         old_n_examples = 0
 
-                    new_n_examples = old_n_examples + len(indices)
+                    new_n_examples = old_n_examples + int(end - start)
                     h5f.attrs['n_examples'] = new_n_examples
 
-                    for data_label, data in data_dict.items():
-                        # Extract elements corresponding to current indices
-                        elements = data[indices]
+                    for data_label, data in sorted_data_dict.items():
+                        # Extract elements destined for the current file
+                        elements = data[start:end]
 
-                        # Determine appropriate dtype
-                        data_dtype = elements.dtype
-                        if data_dtype.kind == 'S':
-                            dtype = h5py.string_dtype(encoding='utf-8')
-                        elif data_dtype == np.bool_:
-                            dtype = np.bool_
-                        else:
-                            dtype = "i4"
+                        dtype = self.get_h5_dtype(data_label, elements.dtype)
 
                         # Set chunk shape and max shape
                         if elements.ndim > 1:
@@ -1925,13 +2037,57 @@ class DataPreprocessor:
 
         return n_examples
 
+    @contextmanager
+    def open_h5_file(self, output_file_name, exclusive=False):
+        """
+        Open an output HDF5 file for appending.
+
+        When the current process is the only one writing to the output files
+        (``exclusive``), the handle is kept open in an LRU cache so that the
+        file is not reopened for every chunk. Otherwise the file is closed as
+        soon as the caller is done with it, since HDF5 does not support
+        concurrent writers.
+        """
+        if not exclusive:
+            with h5py.File(output_file_name, "a") as h5f:
+                yield h5f
+            return
+
+        h5f = self._open_h5_files.get(output_file_name)
+        if h5f is None:
+            h5f = h5py.File(output_file_name, "a")
+            self._open_h5_files[output_file_name] = h5f
+            if len(self._open_h5_files) > MAX_OPEN_H5_FILES:
+                _, evicted = self._open_h5_files.popitem(last=False)
+                evicted.close()
+        else:
+            self._open_h5_files.move_to_end(output_file_name)
+        yield h5f
+
+    def close_h5_files(self):
+        """
+        Close all HDF5 handles cached by `open_h5_file`.
+        """
+        for h5f in self._open_h5_files.values():
+            h5f.close()
+        self._open_h5_files.clear()
+
     def update_checkpoint(
         self,
         process_checkpoint_path,
         checkpoint_data,
     ):
-        with open(process_checkpoint_path, "w") as file:
+        """
+        Atomically replace the process checkpoint file so that a crash in the
+        middle of a write never leaves a torn checkpoint behind.
+        """
+        # Data appended through cached handles must reach the files before
+        # the checkpoint claims it has been written.
+        for h5f in self._open_h5_files.values():
+            h5f.flush()
+        tmp_checkpoint_path = process_checkpoint_path + ".tmp"
+        with open(tmp_checkpoint_path, "w") as file:
             file.write(
                 f"{checkpoint_data[0]}, {checkpoint_data[1]}, {checkpoint_data[2]}, {checkpoint_data[3]}, {checkpoint_data[4]}"
             )
-            file.flush()
+        os.replace(tmp_checkpoint_path, process_checkpoint_path)
@@ -216,8 +216,15 @@ class DataFrame:
             token_generator: Token generator to be used for processing the data.
         """
 
-        for doc in self.raw_data:
-            tokenized_doc, data_stats = token_generator.encode(doc)
+        ## Generators that can batch the tokenizer calls across docs expose
+        ## `encode_batch`, which returns the `encode` output of every doc
+        encode_batch = getattr(token_generator, "encode_batch", None)
+        if encode_batch is not None:
+            encoded_docs = encode_batch(self.raw_data)
+        else:
+            encoded_docs = map(token_generator.encode, self.raw_data)
+
+        for tokenized_doc, data_stats in encoded_docs:
             for key in data_stats:
                 self.data_stats[key] += data_stats[key]
             if not tokenized_doc:
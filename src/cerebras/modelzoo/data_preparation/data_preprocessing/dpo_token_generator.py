@@ -12,18 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import operator
 import os
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-import ftfy
 import numpy as np
 
 from cerebras.modelzoo.data_preparation.data_preprocessing.utils import (
+    clean_text,
     setup_warning_logging,
-    wikitext_detokenizer,
 )
 
 
+def _utf8_len(text: str) -> int:
+    """
+    Number of bytes in the UTF-8 encoding of the text. ASCII text has one
+    byte per character, so it is not encoded just to be measured.
+    """
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+
 class DPOTokenGenerator:
     def __init__(
         self, params: Dict[str, Any], tokenizer, eos_id: int, pad_id: int
@@ -167,19 +175,41 @@ class DPOTokenGenerator:
 
         return features
 
+    def tokenize_texts(self, texts: List[str]) -> List[Dict[str, List[int]]]:
+        """
+        Tokenizes several texts. Callable tokenizers get all of them in a
+        single batched call, which pays the per-call overhead once.
+
+        Args:
+            texts: Texts to tokenize.
+
+        Returns:
+            List with the output of `tokenize_text` for each text.
+        """
+        if not callable(self.tokenizer):
+            return [self.tokenize_text(text) for text in texts]
+
+        batch = self.tokenizer(texts)
+        return [
+            {key: values[i] for key, values in batch.items()}
+            for i in range(len(texts))
+        ]
+
     def build_tokenized_answer(
-        self, prompt: str, prompt_response: str
+        self,
+        prompt_input_ids: List[int],
+        full_tokenized: Dict[str, List[int]],
     ) -> Dict[str, List[int]]:
         """
-        Tokenizes the prompt and its response using a specific strategy to handle tokenizers
+        Splits the tokenized prompt and response using a specific strategy to handle tokenizers
         where encoding a concatenated string does not simply equal the concatenation of
         encoded strings. Specifically handles cases for tokenizers like Llama's, ensuring
         that `enc(a + b) = enc(a) + enc(a + b)[len(enc(a)):]` holds.
 
         Args:
-            tokenizer (PreTrainedTokenizer): The tokenizer to use for encoding.
-            prompt (str): The prompt text to be encoded.
-            prompt_response (str): The prompt response text to be encoded.
+            prompt_input_ids (List[int]): The token IDs of the prompt text.
+            full_tokenized (Dict[str, List[int]]): The tokenized prompt and
+                response text, as returned by `tokenize_text`.
 
         Returns:
             Dict[str, List[int]]: A dictionary containing tokenized IDs and attention masks
@@ -192,29 +222,10 @@ class DPOTokenGenerator:
             Discussion on tokenization strategy: https://github.com/EleutherAI/lm-evaluation-harness/pull/531#issuecomment-1595586257
         """
 
-        # Tokenize the prompt response without adding special tokens
-        full_tokenized = self.tokenize_text(prompt_response)
-
-        # Tokenize the prompt to get its input IDs
-        prompt_input_ids = self.tokenize_text(prompt)["input_ids"]
-
-        # Extract answer's input IDs and attention mask based on the length of the prompt's input IDs
-        answer_input_ids = full_tokenized["input_ids"][len(prompt_input_ids) :]
-        answer_attention_mask = full_tokenized["attention_mask"][
-            len(prompt_input_ids) :
-        ]
-
-        # Concatenate tokens to form `enc(a) + enc(a + b)[len(enc(a)):]`
-        full_concat_input_ids = np.concatenate(
-            [prompt_input_ids, answer_input_ids]
-        )
-
-        # Prepare input tokens for token by token comparison
-        full_input_ids = np.array(full_tokenized["input_ids"])
-
-        # Check if lengths match, raise an error if they do not
-        assert len(full_input_ids) == len(
-            full_concat_input_ids
+        # `enc(a) + enc(a + b)[len(enc(a)):]` has the same length as
+        # `enc(a + b)` unless the prompt alone tokenizes into more tokens
+        assert len(prompt_input_ids) <= len(
+            full_tokenized["input_ids"]
         ), "Concatenated prompt-response and full prompt-response input ids should have the same length."
 
         # Adjust start index for the response's token IDs based on prompt tokenization
@@ -254,57 +265,56 @@ class DPOTokenGenerator:
             "attention_mask": answer_attention_mask,
         }
 
-    def encode(
+    def extract_prompt_chosen_rejected(
         self, semantic_data_array: List[Dict]
-    ) -> Tuple[List[np.ndarray], Dict]:
+    ) -> Tuple[str, str, str]:
         """
-        Tokenize and encode the doc for DPO.
+        Extract the prompt, chosen and rejected texts from the doc.
 
         Args:
-            doc (tuple): Contains prompt, completion data to encode
+            semantic_data_array (List[Dict]): Semantic regions of the doc.
 
         Returns:
-            -> Tuple[List[np.ndarray], Dict]: Tuple of encoded features for DPO and dataset stats
+            Tuple[str, str, str]: Prompt, chosen and rejected texts. The
+            responses are prefixed with the response delimiter and missing
+            regions are returned as empty strings.
         """
+        prompt = ""
+        chosen = ""
+        rejected = ""
+
+        for item in semantic_data_array:
+            if item['type'] == 'prompt':
+                prompt = item['content'][0]['text'].strip()
+            elif item['type'] == 'chosen':
+                chosen = (
+                    self.response_delimiter + item['content'][0]['text'].strip()
+                )
+            elif item['type'] == 'rejected':
+                rejected = (
+                    self.response_delimiter + item['content'][0]['text'].strip()
+                )
 
-        def extract_prompt_chosen_rejected(data):
-            prompt = ""
-            chosen = ""
-            rejected = ""
-
-            for item in data:
-                if item['type'] == 'prompt':
-                    prompt = item['content'][0]['text'].strip()
-                elif item['type'] == 'chosen':
-                    chosen = (
-                        self.response_delimiter
-                        + item['content'][0]['text'].strip()
-                    )
-                elif item['type'] == 'rejected':
-                    rejected = (
-                        self.response_delimiter
-                        + item['content'][0]['text'].strip()
-                    )
+        return prompt, chosen, rejected
 
-            return prompt, chosen, rejected
+    def _prepare_texts(
+        self, semantic_data_array: List[Dict]
+    ) -> Tuple[Optional[List[str]], Dict]:
+        """
+        Apply the chat template and clean the doc, before tokenization.
 
-        prompt, chosen, rejected = extract_prompt_chosen_rejected(
-            semantic_data_array
-        )
+        Args:
+            semantic_data_array (List[Dict]): Semantic regions of the doc.
 
-        fields = ['chosen', 'rejected']
-        values = [chosen, rejected]
+        Returns:
+            Tuple[Optional[List[str]], Dict]: The prompt, chosen and rejected
+            texts to tokenize, or None if the doc is discarded, and the
+            dataset stats of the doc.
+        """
 
-        # Identify which fields are empty
-        empty_fields = [
-            field for field, value in zip(fields, values) if value == ""
-        ]
-        doc_field = None
-        # Construct the message based on the empty fields
-        if len(empty_fields) > 1:  # If two or more fields are empty
-            doc_field = " and ".join(empty_fields)
-        elif len(empty_fields) == 1:  # If exactly one field is empty
-            doc_field = empty_fields[0]
+        prompt, chosen, rejected = self.extract_prompt_chosen_rejected(
+            semantic_data_array
+        )
 
         # Initialize data_stats
         data_stats = {
@@ -321,10 +331,16 @@ class DPOTokenGenerator:
             "normalized_bytes_count": 0,
         }
 
-        if doc_field:
+        if chosen == "" or rejected == "":
+            # Construct the message based on the empty fields
+            doc_field = " and ".join(
+                field
+                for field, value in (("chosen", chosen), ("rejected", rejected))
+                if value == ""
+            )
             self.logger.warning(f"{doc_field} is empty. Skipping this doc...")
             data_stats["discarded"] = 1
-            return {}, data_stats
+            return None, data_stats
 
         prompt_chosen_input = [
             {"role": "user", "content": prompt},
@@ -350,36 +366,41 @@ class DPOTokenGenerator:
         data_stats["raw_chars_count"] = len(prompt_chosen) + len(
             prompt_rejected
         )
-        data_stats["raw_bytes_count"] = len(
-            prompt_chosen.encode("utf-8")
-        ) + len(prompt_rejected.encode("utf-8"))
+        data_stats["raw_bytes_count"] = _utf8_len(prompt_chosen) + _utf8_len(
+            prompt_rejected
+        )
+        raw_prompt_chosen, raw_prompt_rejected = prompt_chosen, prompt_rejected
 
         data_stats["normalized_chars_count"] = data_stats["raw_chars_count"]
         data_stats["normalized_bytes_count"] = data_stats["raw_bytes_count"]
 
         # Fix text and detokenize if necessary
-        if self.use_ftfy:
-            prompt_chosen = ftfy.fix_text(
-                prompt_chosen, normalization=self.ftfy_normalizer
+        if self.use_ftfy or self.wikitext_detokenize:
+            prompt_chosen = clean_text(
+                prompt_chosen,
+                self.use_ftfy,
+                self.wikitext_detokenize,
+                self.ftfy_normalizer,
             )
-            prompt_rejected = ftfy.fix_text(
-                prompt_rejected, normalization=self.ftfy_normalizer
+            prompt_rejected = clean_text(
+                prompt_rejected,
+                self.use_ftfy,
+                self.wikitext_detokenize,
+                self.ftfy_normalizer,
             )
 
-        if self.wikitext_detokenize:
-            prompt_chosen = wikitext_detokenizer(prompt_chosen)
-            prompt_rejected = wikitext_detokenizer(prompt_rejected)
-
-        if self.use_ftfy or self.wikitext_detokenize:
+        # Only recount when normalization actually changed the text
+        if (
+            prompt_chosen != raw_prompt_chosen
+            or prompt_rejected != raw_prompt_rejected
+        ):
             data_stats["normalized_chars_count"] = len(prompt_chosen) + len(
                 prompt_rejected
             )
-            data_stats["normalized_bytes_count"] = len(
-                prompt_chosen.encode("utf-8")
-            ) + len(prompt_rejected.encode("utf-8"))
+            data_stats["normalized_bytes_count"] = _utf8_len(
+                prompt_chosen
+            ) + _utf8_len(prompt_rejected)
 
-        # Extract prompt after appying chat template
-        last_assistant_index = -1
         # Extract prompt after applying chat template
         last_assistant_index = prompt_chosen.rfind(self.response_delimiter)
         if last_assistant_index == -1:
@@ -387,33 +408,53 @@ class DPOTokenGenerator:
             self.logger.warning(
                 f"Can't determine prompt from the chosen string. No `chosen` substring found. Skipping this doc..."
             )
-            return {}, data_stats
+            return None, data_stats
 
-        truncation_mode = "keep_end"
-        prompt = prompt_chosen[:last_assistant_index]
-        prompt_chosen = (
-            prompt_chosen[:last_assistant_index]
-            + prompt_chosen[
-                last_assistant_index + len(self.response_delimiter) :
-            ]
+        response_start_index = last_assistant_index + len(
+            self.response_delimiter
         )
+        prompt = prompt_chosen[:last_assistant_index]
+        prompt_chosen = prompt + prompt_chosen[response_start_index:]
         prompt_rejected = (
             prompt_rejected[:last_assistant_index]
-            + prompt_rejected[
-                last_assistant_index + len(self.response_delimiter) :
-            ]
+            + prompt_rejected[response_start_index:]
         )
         if not isinstance(prompt, str):
             raise ValueError(f"prompt should be an str but got {type(prompt)}")
-        prompt_tokens = self.tokenize_text(prompt)
+
+        return [prompt, prompt_chosen, prompt_rejected], data_stats
+
+    def _encode_tokenized(
+        self, tokenized_texts: List[Dict[str, List[int]]], data_stats: Dict
+    ) -> Tuple[Dict[str, np.ndarray], Dict]:
+        """
+        Build the DPO sample from the tokenized prompt, chosen and rejected
+        texts returned by `_prepare_texts`.
+
+        Args:
+            tokenized_texts (List[Dict[str, List[int]]]): Output of
+                `tokenize_texts` for the prompt, chosen and rejected texts.
+            data_stats (Dict): Dataset stats of the doc, updated in place.
+
+        Returns:
+            Tuple[Dict[str, np.ndarray], Dict]: Encoded features for DPO and
+            dataset stats.
+        """
+        truncation_mode = "keep_end"
+        prompt_tokens, chosen_full_tokens, rejected_full_tokens = (
+            tokenized_texts
+        )
+        prompt_input_ids = prompt_tokens["input_ids"]
         prompt_tokens = {f"prompt_{k}": v for k, v in prompt_tokens.items()}
 
         chosen_tokens = self.build_tokenized_answer(
-            prompt,
-            prompt_chosen,
+            prompt_input_ids,
+            chosen_full_tokens,
         )
 
-        rejected_tokens = self.build_tokenized_answer(prompt, prompt_rejected)
+        rejected_tokens = self.build_tokenized_answer(
+            prompt_input_ids, rejected_full_tokens
+        )
 
         # Last prompt token might get merged by tokenizer and
         # it should not be included for generation if that happens
@@ -431,13 +472,11 @@ class DPOTokenGenerator:
         # Make sure prompts only have one different token at most an
         # and length only differs by 1 at most
         num_diff_tokens = sum(
-            [
-                a != b
-                for a, b in zip(
-                    chosen_tokens["prompt_input_ids"],
-                    rejected_tokens["prompt_input_ids"],
-                )
-            ]
+            map(
+                operator.ne,
+                chosen_tokens["prompt_input_ids"],
+                rejected_tokens["prompt_input_ids"],
+            )
         )
         num_diff_len = abs(
             chosen_prompt_len_input_ids - rejected_prompt_len_input_ids
@@ -512,81 +551,60 @@ class DPOTokenGenerator:
                         : self.max_seq_length - self.max_prompt_length
                     ]
 
-        # Create labels
-        chosen_sequence_tokens = {
-            k: chosen_tokens[f"prompt_{k}"] + chosen_tokens[k]
-            for k in ["input_ids", "attention_mask"]
-        }
-        rejected_sequence_tokens = {
-            k: rejected_tokens[f"prompt_{k}"] + rejected_tokens[k]
-            for k in ["input_ids", "attention_mask"]
-        }
-
-        chosen_sequence_tokens["labels"] = chosen_sequence_tokens["input_ids"][
-            1:
-        ]
-        chosen_sequence_tokens["labels"][
-            : len(chosen_tokens["prompt_input_ids"]) - 1
-        ] = [self.pad_id] * (len(chosen_tokens["prompt_input_ids"]) - 1)
-        rejected_sequence_tokens["labels"] = rejected_sequence_tokens[
-            "input_ids"
-        ][1:]
-        rejected_sequence_tokens["labels"][
-            : len(rejected_tokens["prompt_input_ids"]) - 1
-        ] = [self.pad_id] * (len(rejected_tokens["prompt_input_ids"]) - 1)
-
-        batch = {}
-        total_pad_tokens = 0
-        for k, toks in {
-            "chosen_": chosen_sequence_tokens,
-            "rejected_": rejected_sequence_tokens,
-        }.items():
-            for type_key, tokens in toks.items():
-                ### HF logic doesn't pad the resulting sequences, Seems like
-                ### they handle it internally in a different flow outside DPOTrainer
-                ### For our use case, we create an empty list of the size of 'sequence_length'
-                ### initialized with pad_token_ids
-                pad_value = self.pad_id
-                if type_key == "token_type_ids":
-                    continue
-                elif type_key.endswith("attention_mask"):
-                    pad_value = 0
-                padded_tokens = [pad_value] * self.max_seq_length
-                ### Copy over only relevant information to the padded tokens list
-                ### Rest of the elements will be pad_token_ids anyway
-                ### If we don't align them to the same size, HDF5 conversion fails
-                ### since the stack operation expects all data_buffers to the same shape
-                padded_tokens[: len(tokens)] = tokens
-                total_pad_tokens += self.max_seq_length - len(tokens)
-                batch[f"{k}{type_key}"] = padded_tokens
-
-        ## Batch is a dict of 6 items {chosen_input_ids, chosen_attn_mask, chosen_labels, rejected_input_ids, rejected_attn_mask, rejected_labels}
-        ## each of which is of length == max_seq_length. Every batch is of (6, max_seq_length) in shape
-        # Do not calculate loss on the prompt
-        batch['chosen_attention_mask'][
-            : (len(chosen_tokens["prompt_input_ids"]) - 1)
-        ] = [0] * (len(chosen_tokens["prompt_input_ids"]) - 1)
-        batch['rejected_attention_mask'][
-            : (len(rejected_tokens["prompt_input_ids"]) - 1)
-        ] = [0] * (len(rejected_tokens["prompt_input_ids"]) - 1)
+        ### HF logic doesn't pad the resulting sequences, Seems like
+        ### they handle it internally in a different flow outside DPOTrainer
+        ### For our use case, we preallocate the (6, max_seq_length) output
+        ### initialized with pad_token_ids (0 for the attention masks) and
+        ### copy over only the relevant tokens. If we don't align them to the
+        ### same size, HDF5 conversion fails since the stack operation expects
+        ### all data_buffers to the same shape
+        ## Rows are {chosen_input_ids, chosen_attn_mask, chosen_labels,
+        ## rejected_input_ids, rejected_attn_mask, rejected_labels}
+        ## All rows share one array, so the masks use `input_ids_dtype` too.
+        ## The leading dim of 1 is kept since the writer concatenates the
+        ## samples of all docs along axis 0
+        sample = np.full(
+            (1, 6, self.max_seq_length),
+            self.pad_id,
+            dtype=getattr(np, self.input_ids_dtype),
+        )
+        stacked_batch = sample[0]
+        stacked_batch[1::3] = 0
+        total_pad_tokens = 6 * self.max_seq_length
+        for row, answer_tokens in ((0, chosen_tokens), (3, rejected_tokens)):
+            prompt_len = len(answer_tokens["prompt_input_ids"])
+            seq_len = prompt_len + len(answer_tokens["input_ids"])
+            input_ids, attention_mask, labels = stacked_batch[row : row + 3]
+            input_ids[:prompt_len] = answer_tokens["prompt_input_ids"]
+            input_ids[prompt_len:seq_len] = answer_tokens["input_ids"]
+            attention_mask[:prompt_len] = answer_tokens["prompt_attention_mask"]
+            attention_mask[prompt_len:seq_len] = answer_tokens["attention_mask"]
+            # Create labels by shifting the input ids
+            labels[: seq_len - 1] = input_ids[1:seq_len]
+            total_pad_tokens -= 3 * seq_len - 1
+
+        # Do not calculate loss on the prompt. An empty prompt masks nothing,
+        # instead of a -1 slice bound masking almost the whole row
+        num_chosen_prompt_masked = max(
+            len(chosen_tokens["prompt_input_ids"]) - 1, 0
+        )
+        num_rejected_prompt_masked = max(
+            len(rejected_tokens["prompt_input_ids"]) - 1, 0
+        )
+        stacked_batch[1, :num_chosen_prompt_masked] = 0
+        stacked_batch[2, :num_chosen_prompt_masked] = self.pad_id
+        stacked_batch[4, :num_rejected_prompt_masked] = 0
+        stacked_batch[5, :num_rejected_prompt_masked] = self.pad_id
 
         total_loss_valid_tokens = (
-            len(batch['chosen_attention_mask'])
-            - (len(chosen_tokens["prompt_input_ids"]) - 1)
-            + len(batch['rejected_attention_mask'])
-            - (len(rejected_tokens["prompt_input_ids"]) - 1)
+            2 * self.max_seq_length
+            - num_chosen_prompt_masked
+            - num_rejected_prompt_masked
         )
         total_masked_tokens = (
             2 * self.max_seq_length
         ) - total_loss_valid_tokens
-        # Convert each list in the batch to a numpy array
-        for key in batch.keys():
-            batch[key] = np.array(batch[key])
-
-        # Stack all elements in the batch dictionary to create a numpy array
-        stacked_batch = np.stack(list(batch.values()), axis=0)
 
-        sample = np.expand_dims(stacked_batch, axis=0)
         data_stats.update(
             {
                 "successful": 1,
@@ -600,6 +618,63 @@ class DPOTokenGenerator:
         data = {"data": sample}
         return data, data_stats
 
+    def encode(
+        self, semantic_data_array: List[Dict]
+    ) -> Tuple[List[np.ndarray], Dict]:
+        """
+        Tokenize and encode the doc for DPO.
+
+        Args:
+            doc (tuple): Contains prompt, completion data to encode
+
+        Returns:
+            -> Tuple[List[np.ndarray], Dict]: Tuple of encoded features for DPO and dataset stats
+        """
+        texts, data_stats = self._prepare_texts(semantic_data_array)
+        if texts is None:
+            return {}, data_stats
+
+        # Tokenize the prompt and both full sequences in one call
+        return self._encode_tokenized(self.tokenize_texts(texts), data_stats)
+
+    def encode_batch(
+        self, docs: List[List[Dict]]
+    ) -> List[Tuple[Dict[str, np.ndarray], Dict]]:
+        """
+        Tokenize and encode several docs for DPO. The texts of all docs are
+        tokenized in a single call, so that fast tokenizers can process the
+        batch in parallel.
+
+        Args:
+            docs (List[List[Dict]]): Semantic data arrays of the docs.
+
+        Returns:
+            List[Tuple[Dict[str, np.ndarray], Dict]]: Output of `encode` for
+            each doc.
+        """
+        prepared_docs = [self._prepare_texts(doc) for doc in docs]
+        all_texts = [
+            text
+            for texts, _ in prepared_docs
+            if texts is not None
+            for text in texts
+        ]
+        all_tokens = self.tokenize_texts(all_texts) if all_texts else []
+
+        results = []
+        offset = 0
+        for texts, data_stats in prepared_docs:
+            if texts is None:
+                results.append(({}, data_stats))
+                continue
+            results.append(
+                self._encode_tokenized(
+                    all_tokens[offset : offset + len(texts)], data_stats
+                )
+            )
+            offset += len(texts)
+        return results
+
     def get_token_id(self, token: str) -> int:
         """
         Get the token ID for the given token.
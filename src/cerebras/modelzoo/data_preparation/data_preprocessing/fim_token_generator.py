@@ -28,9 +28,10 @@ Usage:
     tokenized_data, stats = tokenizer.encode("Your sample text to process.")
 """
 
-from collections import defaultdict
 from typing import Any, Dict, List, Tuple
 
+import numpy as np
+
 from cerebras.modelzoo.data_preparation.data_preprocessing.pretraining_token_generator import (
     PretrainingTokenGenerator,
 )
@@ -59,6 +60,12 @@ class FIMTokenGenerator(PretrainingTokenGenerator):
         processing_params = params.get("processing", {})
         self.fim_rate = dataset_params.pop("fim_rate", None)
         self.spm_rate = dataset_params.pop("spm_rate", None)
+        # Split at token boundaries instead of character boundaries, which
+        # skips the detokenize/retokenize round trip of each FIM'ed context.
+        self.fim_token_level = dataset_params.pop("fim_token_level", False)
+        # Kept separate from the parent's `self.rng`, which is a
+        # `random.Random` used for short sequences
+        self.fim_rng = np.random.default_rng(self.seed)
 
         # Ensures that FIM tokens are specified in config, and that
         # the specified tokens are actually in the tokenizer
@@ -103,9 +110,8 @@ class FIMTokenGenerator(PretrainingTokenGenerator):
         num_pad_tokens = 0
         loss_valid_tokens = 0
         num_tokens = 0
-        tokenized_data_stats = defaultdict(int)
         for i, sample in enumerate(tokenized_data):
-            if sample != []:
+            if len(sample) != 0:
                 sample = fim(
                     sample,
                     i,
@@ -118,17 +124,25 @@ class FIMTokenGenerator(PretrainingTokenGenerator):
                     self.pad_id,
                     self.eos_id,
                     self.opt_bos_tok_id,
+                    rng=self.fim_rng,
+                    token_level=self.fim_token_level,
                 )
-                sample_data_stats = get_data_stats(
-                    sample, self.pad_id, self.eos_id, self.max_seq_length
-                )
-                for key in sample_data_stats:
-                    tokenized_data_stats[key] += sample_data_stats[key]
                 result.append(sample)
 
         if not result:
             data = {}
         else:
             data = {"data": result}
+            # All the stats are sums over tokens, so compute them in one pass
+            # over the input ids and masks of every sample laid end to end.
+            flat_samples = (
+                np.stack(result)[:, :2].transpose(1, 0, 2).reshape(2, -1)
+            )
+            tokenized_data_stats = get_data_stats(
+                flat_samples,
+                self.pad_id,
+                self.eos_id,
+                self.max_seq_length * len(result),
+            )
             data_stats.update(tokenized_data_stats)
         return data, data_stats
@@ -23,6 +23,7 @@ from cerebras.modelzoo.data_preparation.data_preprocessing.utils import (
     find_region_in_formatted_string,
     find_token_range,
     get_data_stats,
+    get_offset_bounds,
     setup_warning_logging,
     truncate_sequence,
 )
@@ -322,11 +323,13 @@ class FinetuningTokenGenerator:
 
         tokenized_semantic_region_list = []
         starting_offset_index = 0
+        offset_bounds = get_offset_bounds(tokenized_data["offset_mapping"])
         for text_semantic_region in text_semantic_regions:
             tokenized_semantic_region = find_token_range(
                 text_semantic_region,
                 tokenized_data["offset_mapping"],
                 starting_offset_index,
+                offset_bounds,
             )
             start_token_idx, end_token_idx = tokenized_semantic_region[
                 "indices"
@@ -35,6 +35,7 @@ from cerebras.modelzoo.data_preparation.data_preprocessing.utils import (
     clean_text,
     find_token_range,
     get_data_stats,
+    get_offset_bounds,
     setup_warning_logging,
     split_text_and_tokenize,
 )
@@ -547,12 +548,14 @@ class PretrainingTokenGenerator:
         tokenized_semantic_region_list = []
         tokenized_semantic_region = None
         starting_offset_index = 0
+        offset_bounds = get_offset_bounds(tokenized_data["offset_mapping"])
         for region in semantic_region_list:
             region_name = region.get("region_modality")
             tokenized_semantic_region = find_token_range(
                 region,
                 tokenized_data["offset_mapping"],
                 starting_offset_index,
+                offset_bounds,
             )
             tokenized_semantic_region["region_modality"] = region_name
             starting_offset_index = tokenized_semantic_region["indices"][1]
@@ -0,0 +1,47 @@
+# Copyright 2022 Cerebras Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the DataPreprocessor configuration handling."""
+
+import pytest
+
+pytest.importorskip("h5py")
+pytest.importorskip("datasets")
+
+from cerebras.modelzoo.data_preparation.data_preprocessing.data_preprocessor import (  # noqa: E402
+    DataPreprocessor,
+)
+
+
+def test_shuffle_rejects_checkpoint_interval(tmp_path):
+    # With shuffle, chunks written after the last checkpoint are appended to
+    # shared output files, so resuming from a coalesced checkpoint would
+    # write them a second time
+    params = {
+        "setup": {
+            "output_dir": str(tmp_path / "output"),
+            "mode": "pretraining",
+            "processes": 2,
+            "data": {"type": "local", "source": str(tmp_path)},
+        },
+        "processing": {
+            "shuffle": True,
+            "checkpoint_interval": 4,
+            "read_hook": "cerebras.modelzoo.data_preparation.data_preprocessing.hooks:text_read_hook",
+            "read_hook_kwargs": {"data_key": "text"},
+        },
+        "dataset": {},
+    }
+    with pytest.raises(ValueError, match="checkpoint_interval"):
+        DataPreprocessor(params)
@@ -0,0 +1,65 @@
+# Copyright 2022 Cerebras Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the DPO token generator."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("transformers")
+
+from cerebras.modelzoo.data_preparation.data_preprocessing.dpo_token_generator import (  # noqa: E402
+    DPOTokenGenerator,
+)
+
+
+class _Tokenizer:
+    """Minimal tokenizer that already adds a BOS token, so the generator
+    does not prepend one to the prompt."""
+
+    name_or_path = "test"
+    add_bos_token = True
+    bos_token_id = 1
+
+    def add_special_tokens(self, special_tokens):
+        pass
+
+    def convert_tokens_to_ids(self, token):
+        return 0
+
+
+def test_empty_prompt_masks_nothing(tmp_path):
+    params = {
+        "dataset": {},
+        "processing": {"max_seq_length": 8},
+        "setup": {"output_dir": str(tmp_path)},
+    }
+    token_generator = DPOTokenGenerator(params, _Tokenizer(), 2, 0)
+    tokenized_texts = [
+        {"input_ids": [], "attention_mask": []},
+        {"input_ids": [11, 12, 13], "attention_mask": [1, 1, 1]},
+        {"input_ids": [21, 22], "attention_mask": [1, 1]},
+    ]
+
+    data, data_stats = token_generator._encode_tokenized(tokenized_texts, {})
+
+    sample = data["data"][0]
+    np.testing.assert_array_equal(sample[0, :4], [11, 12, 13, 2])
+    np.testing.assert_array_equal(sample[1, :5], [1, 1, 1, 1, 0])
+    np.testing.assert_array_equal(sample[2, :3], [12, 13, 2])
+    np.testing.assert_array_equal(sample[3, :3], [21, 22, 2])
+    np.testing.assert_array_equal(sample[4, :4], [1, 1, 1, 0])
+    np.testing.assert_array_equal(sample[5, :2], [22, 2])
+    assert data_stats["num_masked_tokens"] == 0
+    assert data_stats["loss_valid_tokens"] == 2 * 8
@@ -13,19 +13,29 @@
 # limitations under the License.
 
 import argparse
-import copy
+import bisect
+import functools
+import gc
+import itertools
 import json
 import logging
 import os
 import re
 import sys
-from collections import OrderedDict, defaultdict
-from pathlib import Path
+from collections import defaultdict, deque
+from types import FunctionType, ModuleType
 from typing import Dict, Optional
 
 import numpy as np
 import yaml
 
+try:
+    # Use the libyaml bindings when available, they are much faster than the
+    # pure Python loader.
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 logger = logging.getLogger("utils")
 logger.setLevel(logging.INFO)
 
@@ -39,6 +49,7 @@ VALID_EXTENSIONS = [
     '.parquet',
     '.fasta',
 ]
+_VALID_EXTENSIONS_TUPLE = tuple(VALID_EXTENSIONS)
 
 
 SYSTEM_PROMPT_REGISTRY = {
@@ -65,22 +76,52 @@ SYSTEM_PROMPT_REGISTRY = {
 
 
 def has_valid_extension(file):
-    return any([file.endswith(ext) for ext in VALID_EXTENSIONS])
+    return file.endswith(_VALID_EXTENSIONS_TUPLE)
 
 
 def _listdir_or_file(x):
+    """
+    Yield the files with a valid extension under `x`. Entries are filtered as
+    the directory is scanned, so no unfiltered listing is built.
+    """
     if isinstance(x, list):
-        return reduce(lambda x, y: x + y, map(listdir_or_file, sorted(x)))
-    if os.path.isfile(x):
-        return [x]
-    elif os.path.isdir(x):
-        return [str(Path(x) / fn) for fn in sorted(os.listdir(x))]
-    else:
+        for path in sorted(x):
+            yield from _listdir_or_file(path)
+        return
+    # Let `os.scandir` tell files and directories apart instead of issuing
+    # separate `stat` calls for `isfile`/`isdir`.
+    try:
+        with os.scandir(x) as entries:
+            paths = sorted(
+                entry.path
+                for entry in entries
+                if entry.name.endswith(_VALID_EXTENSIONS_TUPLE)
+            )
+    except NotADirectoryError:
+        paths = [x] if has_valid_extension(x) else []
+    except FileNotFoundError:
         raise FileNotFoundError(f"{x} not found")
+    yield from paths
 
 
 def listdir_or_file(x):
-    return list(filter(has_valid_extension, _listdir_or_file(x)))
+    return list(_listdir_or_file(x))
+
+
+def _read_json(json_file):
+    """
+    Read a JSON file.
+    """
+    with open(json_file, "r") as _fin:
+        return json.load(_fin)
+
+
+def _write_json(data, json_file):
+    """
+    Write `data` to a human readable, key sorted JSON file.
+    """
+    with open(json_file, "w") as _fout:
+        json.dump(data, _fout, indent=4, sort_keys=True)
 
 
 def dump_result(
@@ -93,8 +134,7 @@ def dump_result(
     """
     Write outputs of execution
     """
-    with open(json_params_file, "r") as _fin:
-        data = json.load(_fin)
+    data = _read_json(json_params_file)
 
     post_process = {}
     post_process["discarded_files"] = results.pop("discarded", 0)
@@ -116,8 +156,7 @@ def dump_result(
         post_process["vocab_size"] = vocab_size
 
     data["post-process"] = post_process
-    with open(json_params_file, "w") as _fout:
-        json.dump(data, _fout, indent=4, sort_keys=True)
+    _write_json(data, json_params_file)
 
 
 def dump_args(args, json_params_file):
@@ -126,32 +165,14 @@ def dump_args(args, json_params_file):
     """
     logger.info(f"User arguments can be found at {json_params_file}.")
 
-    redundant_params = [
-        "eos_id",
-        "pad_id",
-        "display_pbar",
-        "files_per_record",
-        "output_name",
-        "write_remainder",
-    ]
-
-    relevant_args = copy.deepcopy(args)
-    # Iterate through the dictionary and remove the redundant params
-    for key in redundant_params:
-        for sub_dict in relevant_args.values():
-            if key in sub_dict:
-                del sub_dict[key]
-
     # write initial params to file
-    with open(json_params_file, "w") as _fout:
-        json.dump(args, _fout, indent=4, sort_keys=True)
+    _write_json(args, json_params_file)
 
 
 def update_args(args, json_params_file):
     "Update eos_id and pad_id in data_params"
 
-    with open(json_params_file, "r") as _file:
-        data = json.load(_file)
+    data = _read_json(json_params_file)
 
     data['processing']['pad_id'] = args.get(
         'pad_id', data['processing'].get('pad_id')
@@ -161,8 +182,7 @@ def update_args(args, json_params_file):
     )
     data['features'] = args.get('features', None)
 
-    with open(json_params_file, "w") as _fout:
-        json.dump(data, _fout, indent=4, sort_keys=True)
+    _write_json(data, json_params_file)
 
 
 def get_parser(desc):
@@ -186,11 +206,9 @@ def add_preprocess_args(parser):
     )
 
 
-def update_params(params, args):
-    """
-    Update config parameters with CLI arguments
-    """
-    setup_params = [
+## Params accepted in each section of the preprocessing config
+SETUP_PARAMS = frozenset(
+    [
         "data",
         "metadata_files",
         "output_dir",
@@ -198,7 +216,9 @@ def update_params(params, args):
         "processes",
         "mode",
     ]
-    processing_params = [
+)
+PROCESSING_PARAMS = frozenset(
+    [
         "custom_tokenizer",
         "huggingface_tokenizer",
         "tokenizer_params",
@@ -215,6 +235,8 @@ def update_params(params, args):
         "short_seq_prob",
         "write_in_batch",
         "resume_from_checkpoint",
+        "checkpoint_interval",
+        "compression",
         "seed",
         "read_chunk_size",
         "write_chunk_size",
@@ -227,7 +249,9 @@ def update_params(params, args):
         "semantic_loss_weight",
         "semantic_attention_mask",
     ]
-    dataset_params = [
+)
+DATASET_PARAMS = frozenset(
+    [
         "use_vsl",
         "truncate_to_msl",
         "max_prompt_length",
@@ -240,6 +264,7 @@ def update_params(params, args):
         "fim_prefix_tok",
         "fim_middle_tok",
         "fim_suffix_tok",
+        "fim_token_level",
         "fold_long_doc",
         "split_text_to_tokenize",
         "chunk_len_to_split",
@@ -255,45 +280,51 @@ def update_params(params, args):
         "excluded_tokens",
         "max_num_img",
     ]
-    cli_params = [
+)
+CLI_PARAMS = frozenset(
+    [
         "cmd",
         "func",
     ]
+)
+_PARAM_SECTIONS = {
+    "setup": SETUP_PARAMS,
+    "processing": PROCESSING_PARAMS,
+    "dataset": DATASET_PARAMS,
+}
+## Maps every known param to the section it belongs to
+_PARAM_TO_SECTION = {
+    param: section
+    for section, section_params in _PARAM_SECTIONS.items()
+    for param in section_params
+}
 
+
+def update_params(params, args):
+    """
+    Update config parameters with CLI arguments
+    """
     for key, value in args.items():
         if value in ["True", "False"]:
             value = value == "True"
         if value is not None:
-            if key in setup_params:
-                params["setup"][key] = value
-            elif key in processing_params:
-                params["processing"][key] = value
-            elif key in dataset_params:
-                params["dataset"][key] = value
-            elif key in cli_params:
+            section = _PARAM_TO_SECTION.get(key)
+            if section is not None:
+                params[section][key] = value
+            elif key in CLI_PARAMS:
                 continue
             else:
                 raise ValueError(f"Unexpected arguments: {key}")
 
-    # Sections to check
-    sections = {
-        "setup": setup_params,
-        "processing": processing_params,
-        "dataset": dataset_params,
-    }
-
-    for section, allowed_params in sections.items():
+    for section, allowed_params in _PARAM_SECTIONS.items():
 
         params_in_yaml = params.get(section, {})
 
         # Check for misplaced parameters
         for param in params_in_yaml:
             if param not in allowed_params:
-                correct_section = next(
-                    (s for s, p in sections.items() if param in p),
-                    "unknown section",
-                )
-                if correct_section != "unknown section":
+                correct_section = _PARAM_TO_SECTION.get(param)
+                if correct_section is not None:
                     raise ValueError(
                         f"Error: Parameter '{param}' in section '{section}' is misplaced. It should be in '{correct_section}'."
                     )
@@ -310,7 +341,7 @@ def args_to_params(args):
     params_file = args.pop("config", None)
     if params_file:
         with open(params_file, 'r') as stream:
-            params = yaml.safe_load(stream)
+            params = yaml.load(stream, Loader=SafeLoader)
     else:
         params = {}
 
@@ -337,8 +368,7 @@ def dump_args(args, json_params_file):
     Write the input params to file.
     """
     # write initial params to file
-    with open(json_params_file, "w") as _fout:
-        json.dump(args, _fout, indent=4, sort_keys=True)
+    _write_json(args, json_params_file)
 
 
 def setup_warning_logging(output_dir, module_name):
@@ -382,15 +412,7 @@ def get_files(input_dir=None, filetypes=None, metadata_files=None):
         List of lists containing all file paths as strings
     """
     if not filetypes:
-        filetypes = [
-            '.jsonl',
-            '.json.gz',
-            '.jsonl.zst',
-            '.jsonl.zst.tar',
-            '.txt',
-            '.parquet',
-            '.fasta',
-        ]
+        filetypes = _VALID_EXTENSIONS_TUPLE
     if isinstance(filetypes, str):
         filetypes = [filetypes]
     filetypes = tuple(filetypes)
@@ -416,9 +438,12 @@ def get_files(input_dir=None, filetypes=None, metadata_files=None):
         input_files_list = [x.strip() for x in input_files if x]
         flattened_list = [x for x in input_files_list if x.endswith(filetypes)]
     else:
-        files = [list(Path(input_dir).rglob(f"*{ft}")) for ft in filetypes]
-        # flatten list of list -> list and stringify Paths
-        flattened_list = [str(item) for sublist in files for item in sublist]
+        # walk the tree once and filter on all extensions at the same time
+        flattened_list = []
+        for root, _, files in os.walk(input_dir):
+            flattened_list.extend(
+                os.path.join(root, fn) for fn in files if fn.endswith(filetypes)
+            )
     if not flattened_list:
         raise Exception(
             f"Did not find any files at this path {input_dir}, please "
@@ -427,6 +452,16 @@ def get_files(input_dir=None, filetypes=None, metadata_files=None):
     return flattened_list
 
 
+_WIKITEXT_CONTRACTION_RE = re.compile(r"/' [0-9]/")
+_WIKITEXT_BRACKET_RES = [
+    (re.compile(r"\(\s*([^\)]*?)\s*\)"), r"(\1)"),
+    (re.compile(r"\[\s*([^\]]*?)\s*\]"), r"[\1]"),
+    (re.compile(r"{\s*([^}]*?)\s*}"), r"{\1}"),
+    (re.compile(r"\"\s*([^\"]*?)\s*\""), r'"\1"'),
+    (re.compile(r"'\s*([^']*?)\s*'"), r"'\1'"),
+]
+
+
 def wikitext_detokenizer(string):
     """Detokenizer for wikitext. Used for special handling of data for substrings.
 
@@ -438,7 +473,7 @@ def wikitext_detokenizer(string):
     """
     # contractions
     string = string.replace("s '", "s'")
-    string = re.sub(r"/' [0-9]/", r"/'[0-9]/", string)
+    string = _WIKITEXT_CONTRACTION_RE.sub(r"/'[0-9]/", string)
     # number separators
     string = string.replace(" @-@ ", "-")
     string = string.replace(" @,@ ", ",")
@@ -451,11 +486,8 @@ def wikitext_detokenizer(string):
     string = string.replace(" ? ", "? ")
     string = string.replace(" , ", ", ")
     # double brackets
-    string = re.sub(r"\(\s*([^\)]*?)\s*\)", r"(\1)", string)
-    string = re.sub(r"\[\s*([^\]]*?)\s*\]", r"[\1]", string)
-    string = re.sub(r"{\s*([^}]*?)\s*}", r"{\1}", string)
-    string = re.sub(r"\"\s*([^\"]*?)\s*\"", r'"\1"', string)
-    string = re.sub(r"'\s*([^']*?)\s*'", r"'\1'", string)
+    for pattern, repl in _WIKITEXT_BRACKET_RES:
+        string = pattern.sub(repl, string)
     # miscellaneous
     string = string.replace("= = = =", "====")
     string = string.replace("= = =", "===")
@@ -469,6 +501,45 @@ def wikitext_detokenizer(string):
     return string
 
 
+_ftfy = None
+
+
+def _get_ftfy():
+    """
+    Import `ftfy` on first use only, so that the import machinery is not
+    invoked for every document that gets cleaned.
+    """
+    global _ftfy
+    if _ftfy is None:
+        import ftfy
+
+        _ftfy = ftfy
+    return _ftfy
+
+
+## `ftfy.fix_text` leaves text made only of these characters unchanged:
+## there is no mojibake, HTML entity, control character or line break to
+## fix, and ASCII is already in every normalization form
+_FTFY_NOOP_TEXT = re.compile(r"[\t\n\x20-\x25\x27-\x7e]*")
+
+
+def fix_text(data: str, ftfy_normalizer: str) -> str:
+    """
+    Fix the text with `ftfy`, skipping the call for plain ASCII text that
+    `ftfy` would return unchanged.
+
+    Args:
+        data (str): The text to be fixed.
+        ftfy_normalizer (str): The normalization method to use with `ftfy`.
+
+    Returns:
+        str: The fixed text.
+    """
+    if data.isascii() and _FTFY_NOOP_TEXT.fullmatch(data):
+        return data
+    return _get_ftfy().fix_text(data, normalization=ftfy_normalizer)
+
+
 def clean_text(
     data: str, use_ftfy: bool, wikitext_detokenize: bool, ftfy_normalizer: str
 ) -> str:
@@ -484,10 +555,8 @@ def clean_text(
     Returns:
         str: The cleaned text after applying the specified operations.
     """
-    import ftfy
-
     if use_ftfy:
-        data = ftfy.fix_text(data, normalization=ftfy_normalizer)
+        data = fix_text(data, ftfy_normalizer)
     if wikitext_detokenize:
         data = wikitext_detokenizer(data)
 
@@ -519,14 +588,24 @@ def get_data_stats(
             - "loss_valid_tokens": Number of valid tokens for loss computation.
             - "num_masked_tokens": Number of masked tokens based on the maximum sequence length.
     """
-    stats = defaultdict(int)
-    if sample == []:
+    stats = {
+        "num_pad_tokens": 0,
+        "non_pad_tokens": 0,
+        "num_tokens": 0,
+        "loss_valid_tokens": 0,
+        "num_masked_tokens": 0,
+    }
+    if isinstance(sample, list) and not sample:
         return stats
-    stats["num_pad_tokens"] = int((sample[0, :] == pad_id).sum())
-    stats["non_pad_tokens"] = int(
-        np.logical_and(sample[0, :] != eos_id, sample[0, :] != pad_id).sum()
+    input_ids = sample[0, :]
+    num_tokens = int(input_ids.shape[0])
+    num_pad_tokens = int(np.count_nonzero(input_ids == pad_id))
+    num_eos_tokens = (
+        0 if eos_id == pad_id else int(np.count_nonzero(input_ids == eos_id))
     )
-    stats["num_tokens"] = int(sample[0, :].shape[0])
+    stats["num_pad_tokens"] = num_pad_tokens
+    stats["non_pad_tokens"] = num_tokens - num_pad_tokens - num_eos_tokens
+    stats["num_tokens"] = num_tokens
 
     if loss_valid_tokens:
         stats["loss_valid_tokens"] = loss_valid_tokens
@@ -559,7 +638,7 @@ def split_text_and_tokenize(
         return []
 
     curr_start = 0
-    tok_ids = []
+    substrs = []
 
     while curr_start < len(text):
         curr_end = min(text.find(' ', curr_start + max_tok_len), len(text))
@@ -568,21 +647,40 @@ def split_text_and_tokenize(
             curr_end = len(text)
         else:
             curr_substr = text[curr_start:curr_end]
-        if curr_start == 0:
-            # keep special tokens for the first chunk
-            bos_token_id = [tokenizer.encode(curr_substr)[0]]
-        curr_tok_ids = (
-            tokenizer.encode(curr_substr)[1:]
-            if remove_bos_in_chunks
-            else tokenizer.encode(curr_substr)
-        )
-        tok_ids.extend(curr_tok_ids)
+        substrs.append(curr_substr)
         curr_start = curr_end
-    # concatenated tok_ids chunks together by using `extend` to return full sequence of tokens
+
+    # encode all chunks in a single call rather than one call per chunk
+    if getattr(tokenizer, "is_fast", False):
+        chunk_tok_ids = tokenizer(substrs)["input_ids"]
+    else:
+        chunk_tok_ids = [tokenizer.encode(substr) for substr in substrs]
+
+    if not remove_bos_in_chunks:
+        return [tok_id for tok_ids in chunk_tok_ids for tok_id in tok_ids]
 
     # NOTE: add bos token id if it is needed here, eos id is added in the next line
-    # which calls this function
-    return bos_token_id + tok_ids if remove_bos_in_chunks else tok_ids
+    # which calls this function. Special tokens are kept for the first chunk.
+    tok_ids = [chunk_tok_ids[0][0]]
+    for curr_tok_ids in chunk_tok_ids:
+        tok_ids.extend(curr_tok_ids[1:])
+    return tok_ids
+
+
+class _GlobalRandomState:
+    """
+    Exposes the `np.random.Generator` methods used by `chunk` on top of the
+    legacy global numpy random state, so that callers which do not pass a
+    generator stay reproducible through `np.random.seed`.
+    """
+
+    @staticmethod
+    def random():
+        return np.random.random()
+
+    @staticmethod
+    def integers(low, high, size=None):
+        return np.random.randint(low=low, high=high, size=size)
 
 
 def chunk(
@@ -590,6 +688,8 @@ def chunk(
     tokenizer,
     fim_rate,
     spm_rate,
+    rng=None,
+    token_level=False,
 ):
     """
     Since we do character-level FIM we need to detokenize, determine boundaries
@@ -605,6 +705,12 @@ def chunk(
         tokenizer (Tokenizer):
         fim_rate (float):
         spm_rate (float):
+        rng (np.random.Generator, optional): Random generator used to sample
+          the FIM decisions and boundaries. Defaults to the global numpy
+          random state.
+        token_level (bool): Pick the FIM boundaries between tokens instead of
+          characters. The sample is then split directly, which avoids the
+          decode and re-encode round trip through the tokenizer.
 
     Returns:
         List[List[int]], str: List of token lists corresponding to the
@@ -613,14 +719,27 @@ def chunk(
           string representing the format of the sequence (i.e. SPM or
           PSM or AR)
     """
-    if np.random.binomial(1, fim_rate):  # sample bernoulli dist
+    if rng is None:
+        rng = _GlobalRandomState
+    if rng.random() < fim_rate:  # sample bernoulli dist
+        if token_level:
+            boundaries = sorted(
+                rng.integers(low=0, high=len(sample) + 1, size=2)
+            )
+            prefix = sample[: boundaries[0]].tolist()
+            middle = sample[boundaries[0] : boundaries[1]].tolist()
+            suffix = sample[boundaries[1] :].tolist()
+            is_spm = rng.random() < spm_rate
+            fim_format = "SPM" if is_spm else "PSM"
+            return [prefix, middle, suffix], fim_format
+
         contents = tokenizer.decode(sample, skip_special_tokens=False)
         try:
             # A boundary can be =0 (prefix will be empty)
             # a boundary can be =len(contents) (suffix will be empty)
             # The two boundaries can be equal (middle will be empty)
             boundaries = list(
-                np.random.randint(low=0, high=len(contents) + 1, size=2)
+                rng.integers(low=0, high=len(contents) + 1, size=2)
             )
             boundaries.sort()
         except ValueError as e:
@@ -637,7 +756,7 @@ def chunk(
         middle = tokenizer.encode(middle)
         suffix = tokenizer.encode(suffix)
 
-        is_spm = np.random.binomial(1, spm_rate)
+        is_spm = rng.random() < spm_rate
         fim_format = "SPM" if is_spm else "PSM"
         return [prefix, middle, suffix], fim_format
     else:
@@ -654,6 +773,7 @@ def format_fim(
     middle_tok_id,
     eos_tok_id,
     opt_bos_tok_id,
+    out=None,
 ):
     """
     Takes in list of prefix/middle/suffix token lists, along with respective FIM (or AR) formats.
@@ -674,6 +794,9 @@ def format_fim(
           otherwise will be empty list. Empty list will be a no-op in the
           concatenation. Bos-token will only exist if model's tokenizer adds
           bos-token by default. Both have to be lists so that np concat works
+        out (np.array, optional): Preallocated (3, max_seq_len) array whose
+          rows are filled with the sample, mask and label, and returned as
+          views. Raises a ValueError if the sequence does not fit it.
 
     Returns:
         sample (np.array): Array of token ids in the FIMed order
@@ -686,13 +809,15 @@ def format_fim(
     """
 
     prefix_idx, middle_idx, suffix_idx = 0, 1, 2
-    sample = []
+    # Collect the pieces of every sub-context in their final order, then copy
+    # them once into a single buffer in one pass over all of their tokens.
+    pieces = []
     total_padding_len = 0
     for sample_i, fim_format in segment_fim_format_pairs:
         optional_padding = sample_i[-1] if len(sample_i) > 3 else []
         total_padding_len += len(optional_padding)
         if fim_format == "PSM":
-            sample_i = np.concatenate(
+            pieces.extend(
                 [
                     opt_bos_tok_id,
                     [prefix_tok_id],
@@ -705,7 +830,7 @@ def format_fim(
                 ]
             )
         elif fim_format == "SPM":
-            sample_i = np.concatenate(
+            pieces.extend(
                 [
                     opt_bos_tok_id,
                     [prefix_tok_id, suffix_tok_id],
@@ -717,7 +842,7 @@ def format_fim(
                 ]
             )
         else:
-            sample_i = np.concatenate(
+            pieces.extend(
                 [
                     opt_bos_tok_id,
                     sample_i[prefix_idx],
@@ -726,15 +851,30 @@ def format_fim(
                     [eos_tok_id],
                 ]
             )
-        sample_i = np.concatenate([sample_i, optional_padding])
-        sample.append(sample_i)
-    sample = np.concatenate(sample).astype(np.int64)
-    label = sample[1:]
-    sample = sample[:-1]
-    sample_mask = np.ones(max_seq_len - total_padding_len)
-    padding_mask = np.zeros(total_padding_len)
-    mask = np.concatenate([sample_mask, padding_mask])
-    return sample, mask, label
+        pieces.append(optional_padding)
+    sample = np.fromiter(
+        itertools.chain.from_iterable(pieces),
+        dtype=np.int64,
+        count=sum(len(piece) for piece in pieces),
+    )
+    seq_len = len(sample) - 1
+    if out is None:
+        mask = np.ones(seq_len)
+        if total_padding_len:
+            mask[-total_padding_len:] = 0
+        return sample[:-1], mask, sample[1:]
+    if out.shape != (3, seq_len):
+        raise ValueError(
+            f"The FIM sequence of length {seq_len} does not fit the output "
+            f"array of shape {out.shape}, expected max sequence length "
+            f"{max_seq_len}."
+        )
+    out[0] = sample[:-1]
+    out[1] = 1
+    if total_padding_len:
+        out[1, -total_padding_len:] = 0
+    out[2] = sample[1:]
+    return out[0], out[1], out[2]
 
 
 def truncate_helper(samples_lst, diff, sample_idx):
@@ -759,31 +899,60 @@ def truncate_helper(samples_lst, diff, sample_idx):
     Returns:
         (List[List[int]]): List of lists of token ids that have been truncated
     """
-    num_groups = len(samples_lst)
-    remove_idxs = [2] * num_groups  # remove from suffixes first
-    i = 0
-
-    while diff:
-        remove_idx_i = remove_idxs[i]
-        sample_i = samples_lst[i]
-        if sample_i[remove_idx_i]:
-            pop_idx = (
-                -1 if remove_idx_i == 2 else 0
-            )  # remove from end of suffix but beginning of prefix
-            sample_i[remove_idx_i].pop(pop_idx)
-            diff -= 1
+    # Contexts are visited round-robin and each visit removes one token, except
+    # for the visit on which a context switches to its next section. Instead of
+    # removing one token at a time, count how many visits each context gets and
+    # remove the corresponding number of tokens from each section with slices.
+    section_lens = [
+        (len(sample_i[2]), len(sample_i[0]), len(sample_i[1]))
+        for sample_i in samples_lst
+    ]
+
+    def removal_counts(lens, visits):
+        # order of removal is end of suffix, beginning of prefix, then
+        # beginning of middle, with one visit spent switching between sections
+        suffix_len, prefix_len, middle_len = lens
+        return (
+            min(visits, suffix_len),
+            min(max(visits - suffix_len - 1, 0), prefix_len),
+            min(max(visits - suffix_len - prefix_len - 2, 0), middle_len),
+        )
+
+    def num_removed(lens, visits):
+        return sum(removal_counts(lens, visits))
+
+    def total_removed(visits):
+        return sum(num_removed(lens, visits) for lens in section_lens)
+
+    # find the round in which the last token gets removed
+    lo, hi = 1, max(sum(lens) + 2 for lens in section_lens)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if total_removed(mid) >= diff:
+            hi = mid
         else:
-            remove_idxs[i] = (
-                remove_idxs[i] + 1
-            ) % 3  # order of removal is end of suffix, beginning of prefix, then beginning of middle
-            if remove_idxs[i] == 1:
-                logging.info(
-                    f"""Context {i} in the {sample_idx}-th data sample has
-                        begun truncating from the middle section, meaning
-                        the prefix and suffix sections have been exhausted.
-                      """
-                )
-        i = (i + 1) % num_groups
+            lo = mid + 1
+    last_round = lo
+
+    remaining = diff - total_removed(last_round - 1)
+    for i, (sample_i, lens) in enumerate(zip(samples_lst, section_lens)):
+        visits = last_round - 1
+        if remaining > 0:
+            visits = last_round
+            remaining -= num_removed(lens, visits) - num_removed(
+                lens, visits - 1
+            )
+        num_suffix, num_prefix, num_middle = removal_counts(lens, visits)
+        del sample_i[2][lens[0] - num_suffix :]
+        del sample_i[0][:num_prefix]
+        del sample_i[1][:num_middle]
+        if visits >= lens[0] + lens[1] + 2:
+            logging.info(
+                f"""Context {i} in the {sample_idx}-th data sample has
+                    begun truncating from the middle section, meaning
+                    the prefix and suffix sections have been exhausted.
+                  """
+            )
 
     return samples_lst
 
@@ -800,7 +969,9 @@ def pad_helper(samples_lst, diff, fim_pad_tok_id):
     Returns:
         (List[List[int]]): List of lists of token ids with padding
     """
-    padding = np.full(np.abs(diff), fim_pad_tok_id)
+    # keep the padding a plain list like the other sections, it is copied into
+    # the output buffer by `format_fim`
+    padding = [fim_pad_tok_id] * abs(diff)
     samples_lst[-1].append(padding)
     return samples_lst
 
@@ -848,6 +1019,8 @@ def fim(
     fim_pad_tok_id,
     eos_tok_id,
     opt_bos_tok_id,
+    rng=None,
+    token_level=False,
 ):
     """
     Takes in an array of input_ids, mask, and labels, and performs the
@@ -869,6 +1042,10 @@ def fim(
           otherwise will be empty list. Empty list will be a no-op in the
           concatenation. Bos-token will only exist if model's tokenizer adds
           bos-token by default.
+        rng (np.random.Generator, optional): Random generator used for the
+          FIM decisions, passed on to `chunk`.
+        token_level (bool): Split sub-contexts at token instead of character
+          boundaries, passed on to `chunk`.
 
     Returns:
         fim_outputs (np.array): Stack of input_ids, mask, and labels after FIM transformation. Mask and labels have been
@@ -877,61 +1054,49 @@ def fim(
     assert (
         fim_rate <= 1 and fim_rate >= 0
     ), "FIM rate must be a probability 0 <= rate <= 1"
-    sample = sample_array[0, :]
-    mask = sample_array[1, :]
+    # Only the input ids are needed, the mask and labels are rebuilt by
+    # `format_fim`. The document views split from the row below are passed
+    # to `chunk` without copying, so keep the row contiguous.
+    sample = np.ascontiguousarray(sample_array[0])
     max_seq_len = sample.shape[0]
 
-    segment_breaks = np.argwhere(
-        sample == eos_tok_id
-    )  # split sample by document
+    # split sample by document, every segment but the first starts with the
+    # EOD token that precedes it
+    segment_breaks = np.flatnonzero(sample == eos_tok_id)
+    documents = np.split(sample, segment_breaks)
+    last_document_idx = len(documents) - 1
     segments_fim_format_pairs = []
-    if segment_breaks.shape != (0, 1):  # FIM each sub-context
-        curr_start_position = 0
-        for loc in np.nditer(segment_breaks):
-            # Only permute non-empty segments.
-            if loc - curr_start_position > 0:
-                segments, fim_format = chunk(
-                    sample=sample[curr_start_position:loc],
-                    tokenizer=tokenizer,
-                    fim_rate=fim_rate,
-                    spm_rate=spm_rate,
-                )
-                segments_fim_format_pairs.append((segments, fim_format))
-            curr_start_position = loc + 1  # jump over the EOD token
-        # Permute the segment after the last EOD
-        segments, fim_format = chunk(
-            sample=sample[curr_start_position:],
-            tokenizer=tokenizer,
-            fim_rate=fim_rate,
-            spm_rate=spm_rate,
-        )
-        segments_fim_format_pairs.append((segments, fim_format))
-    else:  # FIM over full context
+    for document_idx, document in enumerate(documents):
+        if document_idx > 0:
+            document = document[1:]  # jump over the EOD token
+        # Only permute non-empty segments, except for the segment after the
+        # last EOD (or the full context) which is always permuted.
+        if document.size == 0 and document_idx < last_document_idx:
+            continue
         segments, fim_format = chunk(
-            sample=sample,
+            sample=document,
             tokenizer=tokenizer,
             fim_rate=fim_rate,
             spm_rate=spm_rate,
+            rng=rng,
+            token_level=token_level,
         )
         segments_fim_format_pairs.append((segments, fim_format))
 
-    def flatten_2d(arr):
-        return np.concatenate([np.concatenate(subarr) for subarr in arr])
-
-    total_len = flatten_2d(
-        [pair[0] for pair in segments_fim_format_pairs]
-    ).shape[0]
+    total_len = sum(
+        len(section)
+        for segments, _ in segments_fim_format_pairs
+        for section in segments
+    )
     # we factor in the final EOS, which we add before splitting into
     # inputs and labels, i.e. sequence[:-1] and sequence[1:], and the
-    # optional bos token
-    add_constant = -1
-    for _, fmt in segments_fim_format_pairs:
-        if fmt == "AR":
-            add_constant += 1
-        else:
-            add_constant += 4
-        if opt_bos_tok_id:
-            add_constant += 1
+    # optional bos token. AR contexts only add an EOS, FIM contexts also add
+    # the three sentinel tokens.
+    num_contexts = len(segments_fim_format_pairs)
+    num_fim_contexts = sum(fmt != "AR" for _, fmt in segments_fim_format_pairs)
+    add_constant = -1 + num_contexts + 3 * num_fim_contexts
+    if opt_bos_tok_id:
+        add_constant += num_contexts
     diff = (total_len + add_constant) - max_seq_len
     segments_fim_format_pairs = truncate_or_pad_helper(
         segments_fim_format_pairs,
@@ -939,6 +1104,8 @@ def fim(
         fim_pad_tok_id,
         sample_idx,
     )
+    # The mask is a float array, so the stacked outputs are float64
+    fim_outputs = np.empty((3, max_seq_len), dtype=np.float64)
     inputs, mask, labels = format_fim(
         segments_fim_format_pairs,
         max_seq_len,
@@ -947,30 +1114,18 @@ def fim(
         middle_tok_id,
         eos_tok_id,
         opt_bos_tok_id,
+        out=fim_outputs,
     )
 
-    try:
-        assert inputs.shape[0] == max_seq_len
-        assert mask.shape[0] == max_seq_len
-        assert labels.shape[0] == max_seq_len
-    except:
-        logging.error(
-            "The inputs/masks/labels were not the correct\
-                      sized after FIM process. Shapes of each are printed\
-                      below, along with the correct max seqeunce length\
-                      that each sequence should be."
-        )
-        logging.error(inputs.shape, max_seq_len)
-        logging.error(mask.shape, max_seq_len)
-        logging.error(labels.shape, max_seq_len)
-        raise AssertionError
+    # `format_fim` fills the rows of `fim_outputs` in place, or raises if
+    # the sequence does not have the max sequence length
+    assert inputs.base is fim_outputs
     try:
         assert labels[-1] == eos_tok_id
     except:
         logging.error("The sequence did not end with an EOS token")
         raise AssertionError
     # end FIM-specific code
-    fim_outputs = np.stack([inputs, mask, labels], axis=0)
     return fim_outputs
 
 
@@ -1032,34 +1187,53 @@ def handle_bos_token_default(tokenizer):
     """
     if hasattr(tokenizer, "add_bos_token") and tokenizer.add_bos_token:
         tokenizer.add_bos_token = False
-        bos_tok_id = tokenizer.encode(tokenizer.bos_token)[-1]
+        if hasattr(tokenizer, "convert_tokens_to_ids"):
+            # look the bos token up directly instead of running the tokenizer
+            bos_tok_id = tokenizer.convert_tokens_to_ids(tokenizer.bos_token)
+        else:
+            bos_tok_id = tokenizer.encode(tokenizer.bos_token)[-1]
         return True, [bos_tok_id]
     return False, []
 
 
-def get_size(obj, seen=None):
-    """Recursively finds size of objects"""
-    size = sys.getsizeof(obj)
-    if seen is None:
-        seen = set()
-    obj_id = id(obj)
-    if obj_id in seen:
-        return 0
-    # Important mark as seen *before* entering recursion to gracefully handle
-    # self-referential objects
-    seen.add(obj_id)
-    if isinstance(obj, dict):
-        size += sum([get_size(v, seen) for v in obj.values()])
-        size += sum([get_size(k, seen) for k in obj.keys()])
-    elif hasattr(obj, '__dict__'):
-        size += get_size(obj.__dict__, seen)
-    elif hasattr(obj, '__iter__') and not isinstance(
-        obj, (str, bytes, bytearray)
-    ):
-        size += sum([get_size(i, seen) for i in obj])
+## Objects shared by everything, which `get_size` does not count
+_GET_SIZE_SKIPPED_TYPES = (type, ModuleType, FunctionType)
+
+
+def get_size(obj):
+    """
+    Finds the size of an object and all the objects it refers to. The
+    references are walked breadth first with `gc.get_referents`, which lets
+    CPython enumerate the children of every object instead of probing them
+    from Python. Classes, modules and functions are not followed.
+    """
+    size = 0
+    seen = set()
+    pending = deque([obj])
+    while pending:
+        obj = pending.popleft()
+        obj_id = id(obj)
+        if obj_id in seen or isinstance(obj, _GET_SIZE_SKIPPED_TYPES):
+            continue
+        seen.add(obj_id)
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
     return size
 
 
+@functools.lru_cache(maxsize=32)
+def _compile_literal(text, overlapping=False):
+    """
+    Compile a pattern that matches `text` literally. The special tokens
+    searched for are the same for every sample, so they are compiled once.
+    With `overlapping`, the pattern is a lookahead that matches at the start
+    of every occurrence, including overlapping ones.
+    """
+    if overlapping:
+        return re.compile(f"(?={re.escape(text)})")
+    return re.compile(re.escape(text))
+
+
 def append_eos_to_multiple_semantic_regions(
     formatted_data,
     data_ranges,
@@ -1070,45 +1244,63 @@ def append_eos_to_multiple_semantic_regions(
 
     if data_ranges == [] or not eos_token:
         return data_ranges
-    eos_indices = []
-    start_search_index = data_ranges[0].get("indices")[0]
-    while start_search_index < len(formatted_data):
-        eos_start_idx = formatted_data.find(eos_token, start_search_index)
-        if eos_start_idx == -1:
-            ## No eos found. Break
-            break
-        eos_end_idx = eos_start_idx + len(eos_token)
-        start_search_index = eos_end_idx
-        eos_indices.append((eos_start_idx, eos_end_idx))
+    ## Collect all non-overlapping eos occurrences in a single scan
+    eos_indices = [
+        match.span()
+        for match in _compile_literal(eos_token).finditer(
+            formatted_data, data_ranges[0].get("indices")[0]
+        )
+    ]
 
+    ## Start positions of all image tokens, found on the first check and then
+    ## shared by the following ones
+    image_token_starts = None
+
+    def has_image_token(start_idx, end_idx):
+        nonlocal image_token_starts
+        if image_token is None:
+            return False
+        if not image_token:
+            ## an empty token is found in any string
+            return True
+        if image_token_starts is None:
+            image_token_starts = [
+                match.start()
+                for match in _compile_literal(
+                    image_token, overlapping=True
+                ).finditer(formatted_data)
+            ]
+        ## the whole token has to fit in formatted_data[start_idx:end_idx]
+        return bisect.bisect_left(
+            image_token_starts, start_idx
+        ) < bisect.bisect_right(image_token_starts, end_idx - len(image_token))
+
+    ## Only the region being visited gets its indices extended, and it is
+    ## never visited again, so the original bounds can be read up front.
+    region_starts = [region.get("indices")[0] for region in data_ranges]
+    region_ends = [region.get("indices")[1] for region in data_ranges]
+    eos_starts = [eos_start_idx for eos_start_idx, _ in eos_indices]
+    num_eos = len(eos_indices)
+    num_regions = len(data_ranges)
     current_eos_pos = 0
     current_data_range_pos = 0
-    while current_eos_pos < len(eos_indices) and current_data_range_pos < len(
-        data_ranges
-    ):
+    while current_eos_pos < num_eos and current_data_range_pos < num_regions:
         eos_start_idx, eos_end_idx = eos_indices[current_eos_pos]
-        region_start_idx, region_end_idx = data_ranges[
-            current_data_range_pos
-        ].get("indices")
-        ## EOS occurs in the current region
+        region_start_idx = region_starts[current_data_range_pos]
+        region_end_idx = region_ends[current_data_range_pos]
+        ## EOS occurs in the current region, and so do all the following EOS
+        ## that start before the end of the region
         if region_start_idx <= eos_start_idx < region_end_idx:
-            current_eos_pos += 1
+            current_eos_pos = bisect.bisect_left(
+                eos_starts, region_end_idx, lo=current_eos_pos + 1
+            )
             continue
 
-        if current_data_range_pos + 1 < len(data_ranges):
-            next_region_start_idx, next_region_end_idx = data_ranges[
-                current_data_range_pos + 1
-            ].get("indices")
+        if current_data_range_pos + 1 < num_regions:
+            next_region_start_idx = region_starts[current_data_range_pos + 1]
             ## Check if eos occurs between current and next region
             if region_end_idx <= eos_start_idx < next_region_start_idx:
-                image_start_idx = (
-                    -1
-                    if image_token is None
-                    else formatted_data[region_end_idx:eos_start_idx].find(
-                        image_token
-                    )
-                )
-                if image_start_idx == -1:
+                if not has_image_token(region_end_idx, eos_start_idx):
                     indices_incl_eos = (region_start_idx, eos_end_idx)
                     data_ranges[current_data_range_pos][
                         "indices"
@@ -1116,14 +1308,7 @@ def append_eos_to_multiple_semantic_regions(
                     current_eos_pos += 1
         else:
             ## insert EOS in the last region
-            image_start_idx = (
-                -1
-                if image_token is None
-                else formatted_data[region_end_idx:eos_start_idx].find(
-                    image_token
-                )
-            )
-            if image_start_idx == -1:
+            if not has_image_token(region_end_idx, eos_start_idx):
                 indices_incl_eos = (region_start_idx, eos_end_idx)
                 data_ranges[current_data_range_pos][
                     "indices"
@@ -1151,7 +1336,12 @@ def append_eos_to_multiple_semantic_regions(
 
 def find_region_in_formatted_string(text_semantic_region_list, formatted_data):
 
+    ## Rebuild the string without the region identifiers in a single left to
+    ## right pass, the regions are in the same order as in the string.
+    formatted_parts = []
     string_search_idx = 0
+    cut_idx = 0
+    num_removed = 0
     for semantic_region in text_semantic_region_list:
         region_identifier = semantic_region.pop("region_identifier", "")
         region_len = semantic_region.get("region_len")
@@ -1161,41 +1351,86 @@ def find_region_in_formatted_string(text_semantic_region_list, formatted_data):
         assert (
             region_identifier_start_idx != -1
         ), f"Unable to find region_identifier - {region_identifier} in the string - {formatted_data}"
-        formatted_data = formatted_data.replace(region_identifier, "")
-        start_idx = region_identifier_start_idx
+        formatted_parts.append(
+            formatted_data[cut_idx:region_identifier_start_idx]
+        )
+        cut_idx = region_identifier_start_idx + len(region_identifier)
+        start_idx = region_identifier_start_idx - num_removed
         end_idx = start_idx + region_len
-        string_search_idx = end_idx
+        num_removed += len(region_identifier)
+        string_search_idx = cut_idx + region_len
         semantic_region.update({"indices": (start_idx, end_idx)})
+    formatted_parts.append(formatted_data[cut_idx:])
 
-    return formatted_data, text_semantic_region_list
+    return "".join(formatted_parts), text_semantic_region_list
 
 
-def find_token_range(region, offsets, starting_offset_position):
+def get_offset_bounds(offsets):
+    """
+    Split an offset mapping into sorted lists of token start and end
+    positions, which lets `find_token_range` use a binary search instead of
+    a linear scan. Returns None if the offsets are not monotonic, e.g. when
+    the tokenizer appends special tokens with a (0, 0) offset.
+    """
+    starts = []
+    ends = []
+    prev_start, prev_end = 0, 0
+    for start, end in offsets:
+        if start < prev_start or end < prev_end or start > end:
+            return None
+        starts.append(start)
+        ends.append(end)
+        prev_start, prev_end = start, end
+    return starts, ends
+
+
+def find_token_range(
+    region, offsets, starting_offset_position, offset_bounds=None
+):
 
     string_start, string_end = region.pop('indices')
-    token_start = next(
-        (
-            i
-            for i in range(starting_offset_position, len(offsets))
-            if (offsets[i][0] <= string_start and offsets[i][1] > string_start)
-            or (
-                offsets[i][0] > string_start
-            )  ## this condition is useful for neox tokenizer which treats space as an additional token
-        ),
-        None,
-    )
+    if offset_bounds is not None:
+        ## With monotonic offsets the first token ending after string_start is
+        ## the first one that contains or follows it, and the tokens that
+        ## contain string_end form a contiguous range.
+        starts, ends = offset_bounds
+        token_start = bisect.bisect_right(
+            ends, string_start, lo=starting_offset_position
+        )
+        if token_start >= len(ends):
+            token_start = None
+        token_end = bisect.bisect_left(
+            ends, string_end, lo=starting_offset_position
+        )
+        if token_end >= bisect.bisect_left(starts, string_end):
+            token_end = None
+    else:
+        token_start = next(
+            (
+                i
+                for i in range(starting_offset_position, len(offsets))
+                if (
+                    offsets[i][0] <= string_start
+                    and offsets[i][1] > string_start
+                )
+                or (
+                    offsets[i][0] > string_start
+                )  ## this condition is useful for neox tokenizer which treats space as an additional token
+            ),
+            None,
+        )
+        token_end = next(
+            (
+                i
+                for i in range(starting_offset_position, len(offsets))
+                if offsets[i][1] >= string_end and offsets[i][0] < string_end
+            ),
+            None,
+        )
     if token_start is None:
         raise ValueError(
             f"The implementation of offset mapping of this tokenizer may be incorrect. Check the huggingface implementation for more details."
         )
-    token_end = next(
-        (
-            i
-            for i in range(starting_offset_position, len(offsets))
-            if offsets[i][1] >= string_end and offsets[i][0] < string_end
-        ),
-        None,
-    )
     if token_end is None:
         raise ValueError(
             f"The huggingface implementation of offset mapping of this tokenizer may be incorrect. Check the huggingface implementation for more details."
@@ -1240,13 +1475,12 @@ def truncate_sequence(
         combined_list = part_one_list + part_two_list
         combined_list.sort(key=lambda x: x[2][0])
 
-        combined_rem = part_one_indices_to_remove + part_two_indices_to_remove
-        combined_rem_dict = OrderedDict()
-
-        for element in combined_rem:
-            key = (element[0], element[1])
-            value = (element[2], element[3])
-            combined_rem_dict[key] = value
+        combined_rem_dict = {
+            (index, part): (mode, removed_range)
+            for index, part, mode, removed_range in (
+                part_one_indices_to_remove + part_two_indices_to_remove
+            )
+        }
 
         updated_ranges = []
         cumulative_shift = 0
@@ -1254,47 +1488,71 @@ def truncate_sequence(
         for index, part, (original_start, original_end) in combined_list:
             removed_item = combined_rem_dict.get((index, part))
 
-            if removed_item is not None:
-                mode, (removed_start, removed_end) = removed_item
-                current_shift = removed_end - removed_start
-
-                if mode == "keep_start":
-                    new_start, new_end = (
+            if removed_item is None:
+                updated_ranges.append(
+                    (
                         original_start - cumulative_shift,
-                        removed_start - cumulative_shift,
-                    )
-                elif mode == "keep_end":
-                    new_start, new_end = (
-                        removed_end - cumulative_shift - current_shift,
-                        original_end - cumulative_shift - current_shift,
+                        original_end - cumulative_shift,
                     )
+                )
+                continue
 
-                cumulative_shift += current_shift
-            else:
-                current_shift = 0
+            mode, (removed_start, removed_end) = removed_item
+            current_shift = removed_end - removed_start
+
+            if mode == "keep_start":
                 new_start, new_end = (
                     original_start - cumulative_shift,
-                    original_end - cumulative_shift,
+                    removed_start - cumulative_shift,
+                )
+            elif mode == "keep_end":
+                new_start, new_end = (
+                    removed_end - cumulative_shift - current_shift,
+                    original_end - cumulative_shift - current_shift,
                 )
-                cumulative_shift += current_shift
 
+            cumulative_shift += current_shift
             updated_ranges.append((new_start, new_end))
 
-        no_of_regions = 0
-        for region in tokenized_semantic_region_list:
-            no_of_regions += 1
-
-        assert (
-            len(updated_ranges) == no_of_regions
+        assert len(updated_ranges) == len(
+            tokenized_semantic_region_list
         ), "Mismatch in number of regions of tokenized_semantic_region_list and the updated ranges."
 
-        index = 0
-        for region in tokenized_semantic_region_list:
-            region['indices'] = updated_ranges[index]
-            index += 1
+        for region, updated_range in zip(
+            tokenized_semantic_region_list, updated_ranges
+        ):
+            region['indices'] = updated_range
 
         return tokenized_semantic_region_list
 
+    def _remove_token_ranges(indices_to_remove):
+        """
+        Remove the given (start, end) ranges from token_ids in place. The kept
+        ranges are gathered in one pass, deleting every removed range instead
+        would shift all of the following tokens each time.
+        """
+        kept_token_ids = []
+        cursor = 0
+        for _, _, _, (start, end) in sorted(
+            indices_to_remove, key=lambda x: x[3][0]
+        ):
+            kept_token_ids.extend(token_ids[cursor:start])
+            cursor = end
+        kept_token_ids.extend(token_ids[cursor:])
+        token_ids[:] = kept_token_ids
+
+    def _sort_by_length(part_list):
+        """
+        Sort (index, part, (start, end)) entries by decreasing range length,
+        keeping the original order for equal lengths. The lengths are computed
+        once up front instead of in a key function.
+        """
+        lengths = [end - start for _, _, (start, end) in part_list]
+        order = sorted(
+            range(len(part_list)), key=lengths.__getitem__, reverse=True
+        )
+        return [part_list[i] for i in order]
+
     def _truncate(
         tokenized_semantic_region_list,
         part_one_list,
@@ -1328,9 +1586,7 @@ def truncate_sequence(
         part_one_indices_to_remove = []
 
         # Sort the ordered list by maximum turn length, with the maximum length indices coming first.
-        sorted_part_one = sorted(
-            part_one_list, key=lambda x: x[2][1] - x[2][0], reverse=True
-        )
+        sorted_part_one = _sort_by_length(part_one_list)
 
         # Truncate from the first part of the sequence.
         for index, part, (start, end) in sorted_part_one:
@@ -1395,20 +1651,7 @@ def truncate_sequence(
                             )
                         )
 
-                    # Sorting this, in order to not mess up the indices while removing.
-                    range_of_indices_to_remove_part_one = sorted(
-                        part_one_indices_to_remove,
-                        key=lambda x: x[3][0],
-                        reverse=True,
-                    )
-
-                    for (
-                        index,
-                        part,
-                        mode,
-                        (start, end),
-                    ) in range_of_indices_to_remove_part_one:
-                        del token_ids[start:end]
+                    _remove_token_ranges(part_one_indices_to_remove)
 
                     assert (
                         len(token_ids) == max_sequence_length
@@ -1442,9 +1685,7 @@ def truncate_sequence(
             part_two_indices_to_remove = []
 
             # Sorting this by max turn length, so that most of the truncation happens from the longest range.
-            sorted_part_two = sorted(
-                part_two_list, key=lambda x: x[2][1] - x[2][0], reverse=True
-            )
+            sorted_part_two = _sort_by_length(part_two_list)
 
             for index, part, (start, end) in sorted_part_two:
                 length_of_turn = end - start
@@ -1480,14 +1721,9 @@ def truncate_sequence(
                         )
                         break
 
-        # Sorting the indices in descending order, to maintain correctness while deleting.
-        range_of_indices_to_remove = (
+        _remove_token_ranges(
             part_one_indices_to_remove + part_two_indices_to_remove
         )
-        range_of_indices_to_remove.sort(key=lambda x: x[3][0], reverse=True)
-
-        for index, part, mode, (start, end) in range_of_indices_to_remove:
-            del token_ids[start:end]
 
         assert (
             len(token_ids) == max_sequence_length
@@ -1503,11 +1739,8 @@ def truncate_sequence(
         return tokenized_semantic_region_list, token_ids
 
     def _get_truncation_indices(tokenized_semantic_region_list):
-        truncation_indices = {}
+        truncation_indices = defaultdict(list)
         for regions in tokenized_semantic_region_list:
-            if regions['role'] not in truncation_indices:
-                truncation_indices[regions['role']] = []
-
             truncation_indices[regions['role']].append(regions['indices'])
         return truncation_indices
 
@@ -29,14 +29,12 @@ class _LogSummaries(Callback):
     """Callback class caches the trainer instance for summarizing through methods below."""
 
     def __init__(self):
-        self._trainer_stack = []
+        self._trainer = None
 
     @property
     def trainer(self):
         """Return the current trainer instance"""
-        if self._trainer_stack:
-            return self._trainer_stack[-1]
-        return None
+        return self._trainer
 
     def on_enter_train(
         self,
@@ -56,11 +54,12 @@ class _LogSummaries(Callback):
 
     @contextmanager
     def _cache_trainer(self, trainer):
+        # Nested runs restore the outer trainer on exit
+        prev_trainer, self._trainer = self._trainer, trainer
         try:
-            self._trainer_stack.append(trainer)
             yield
         finally:
-            self._trainer_stack.pop()
+            self._trainer = prev_trainer
 
 
 _GLOBAL_SUMMARIES = _LogSummaries()
@@ -74,7 +73,8 @@ def summarize_scalar(name: str, value: torch.Tensor):
         name: The name of the metric.
         value: Scalar value of the metric to log.
     """
-    if not _GLOBAL_SUMMARIES.trainer:
+    trainer = _GLOBAL_SUMMARIES.trainer
+    if not trainer:
         raise RuntimeError(
             "\"summarize_scalar()\" must only be called in the context of a run using the "
             "\"Trainer\" class."
@@ -93,7 +93,7 @@ def summarize_scalar(name: str, value: torch.Tensor):
             f"\tsummarize_tensor('{name}', tensor)\n\n"
         )
 
-    _GLOBAL_SUMMARIES.trainer.log_metrics(**{name: value})
+    trainer.log_metrics(**{name: value})
 
 
 def summarize_tensor(name: str, value: torch.Tensor):
@@ -103,7 +103,8 @@ def summarize_tensor(name: str, value: torch.Tensor):
         name: The name of the metric.
         value: Tensor value of the metric to log.
     """
-    if not _GLOBAL_SUMMARIES.trainer:
+    trainer = _GLOBAL_SUMMARIES.trainer
+    if not trainer:
         raise RuntimeError(
             "\"summarize_scalar()\" must only be called in the context of a run using the "
             "\"Trainer\" class."
@@ -123,4 +124,4 @@ def summarize_tensor(name: str, value: torch.Tensor):
         )
         value = value.reshape(-1)
 
-    _GLOBAL_SUMMARIES.trainer.log_metrics(**{name: value})
+    trainer.log_metrics(**{name: value})
@@ -16,18 +16,22 @@
 This module provides a callback class to run EleutherAI's Evaluation Harness.
 """
 
-from copy import deepcopy
 from functools import cached_property
+from types import SimpleNamespace
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import torch
 from lm_eval.api.instance import Instance
 from lm_eval.api.model import LM
 from lm_eval.api.registry import register_model
+from lm_eval.utils import get_rolling_token_windows, make_disjoint_window
 
 import cerebras.pytorch as cstorch
 from cerebras.appliance.environment import appliance_environ
-from cerebras.modelzoo.data.nlp.gpt.InferenceDataProcessor import RequestType
+from cerebras.modelzoo.data.nlp.gpt.InferenceDataProcessor import (
+    RequestType,
+    get_token_ids,
+)
 from cerebras.modelzoo.trainer.callbacks import (
     Callback,
     ValidationCallback,
@@ -42,11 +46,39 @@ from cerebras.modelzoo.trainer.extensions.eval_harness_adapter import (
     CSEvalHarnessAdapter,
     EvalHarnessProgress,
 )
-from cerebras.pytorch.nn.functional import one_hot
 
 CS_LLM = "cs-llm"
 
 
+def _rolling_windows(
+    token_ids: List[int], prefix_token: int, max_seq_len: int
+) -> List[Tuple[List[int], List[int]]]:
+    # pylint: disable=line-too-long
+    """Splits the token ids into disjoint (context, continuation) windows the
+    same way as `EEH's HF model <lm_eval_hf>`_, so that every token is
+    predicted exactly once with up to `max_seq_len` input tokens.
+
+    .. _lm_eval_hf: https://github.com/EleutherAI/lm-evaluation-harness/blob/c9bbec6e7de418b9082379da82797522eb173054/lm_eval/models/huggingface.py
+
+    Args:
+        token_ids: Token ids of the string to compute the loglikelihood for.
+        prefix_token: Token the first window is conditioned on.
+        max_seq_len: Maximum number of input tokens of each window.
+
+    Returns:
+        List of (context, continuation) token id tuples.
+    """
+    return [
+        make_disjoint_window(window)
+        for window in get_rolling_token_windows(
+            token_list=token_ids,
+            prefix_token=prefix_token,
+            max_seq_len=max_seq_len,
+            context_len=1,
+        )
+    ]
+
+
 @register_model(CS_LLM)
 class EleutherLM(CSEvalHarnessAdapter, LM):
     """Subclasses Eleuther's `LM` base class, overriding the `loglikelihood`
@@ -69,9 +101,9 @@ class EleutherLM(CSEvalHarnessAdapter, LM):
         # pylint: disable=line-too-long
         # Dummy model attr needed for EEH script
         # Ref: https://github.com/EleutherAI/lm-evaluation-harness/blob/c9bbec6e7de418b9082379da82797522eb173054/lm_eval/evaluator.py#L165-L167
-        self.model = lambda: None
-        self.model.config = lambda: None
-        self.model.config._name_or_path = CS_LLM
+        self.model = SimpleNamespace(
+            config=SimpleNamespace(_name_or_path=CS_LLM)
+        )
 
     def loglikelihood(
         self, requests: List[Instance]
@@ -124,11 +156,96 @@ class EleutherLM(CSEvalHarnessAdapter, LM):
             self.logger.debug(f"Output results: {ll.results}")
             return ll.results
 
-    def loglikelihood_rolling(self, requests):
-        raise NotImplementedError(
-            "Loglikelihood rolling is currently not supported"
+    def loglikelihood_rolling(self, requests: List[Instance]) -> List[float]:
+        # pylint: disable=line-too-long
+        """This method provides an implementation for the abstract method of
+        `EEH's LM interface class <lm_eval_model>`_.
+
+        .. _lm_eval_model: https://github.com/EleutherAI/lm-evaluation-harness/blob/c9bbec6e7de418b9082379da82797522eb173054/lm_eval/api/model.py#L62
+
+        Each request string is split into disjoint rolling windows the same
+        way as EEH's HF implementation. The windows of all requests are
+        flattened into a single list of loglikelihood requests so that they
+        are executed in one validation run on the appliance.
+
+        Args:
+            requests: A list of EEH's Instance objects, with property `args` which returns a tuple
+            of (string,) whose full loglikelihood is to be computed.
+
+        Returns:
+            list of size `len(requests)` comprising the summed logprob of
+            all windows of each request string
+        """
+        window_requests = []
+        num_windows = []
+        for request in requests:
+            (string,) = request.args
+            windows = _rolling_windows(
+                get_token_ids(string, self.tokenizer),
+                prefix_token=self.tokenizer.eos_token_id,
+                max_seq_len=self.msl,
+            )
+            window_requests.extend(
+                Instance(
+                    request_type="loglikelihood",
+                    doc=request.doc,
+                    arguments=window,
+                    idx=request.idx,
+                    metadata=(
+                        request.task_name,
+                        request.doc_id,
+                        request.repeats,
+                    ),
+                )
+                for window in windows
+            )
+            num_windows.append(len(windows))
+
+        (
+            samples_file_list,
+            dataset_size,
+            metadata,
+        ) = self.preprocess_dataset(
+            window_requests, RequestType.eeh_loglikelihood
         )
 
+        token_lengths = metadata["requests"]
+        with LogLikelihood(token_lengths) as ll:
+            self.trainer.validate(
+                val_dataloader=cstorch.utils.data.DataLoader(
+                    self.input_fn,
+                    self.dataloader_args,
+                    samples_file_list,
+                    dataset_size,
+                    RequestType.eeh_loglikelihood.value,
+                    **metadata["dataset_kwargs"],
+                ),
+                loop=EleutherEvalHarnessLoop(),
+                ckpt_path=None,
+            )
+
+            if (
+                not self.trainer.backend.is_e2e_execution
+            ):  # Dummy results for compile-only flow
+                return [-0.0] * len(requests)
+
+            # Regroup the window logprobs into per-request sums
+            results = []
+            window_idx = 0
+            for n in num_windows:
+                results.append(
+                    sum(
+                        log_prob
+                        for log_prob, _ in ll.results[
+                            window_idx : window_idx + n
+                        ]
+                    )
+                )
+                window_idx += n
+
+            self.logger.debug(f"Output results: {results}")
+            return results
+
     def generate_until(self, requests: List[Instance]) -> List[str]:
         # pylint: disable=line-too-long
         """This method provides an implementation for the abstract method of
@@ -232,6 +349,27 @@ class EleutherEvalHarnessLoop(ValidationLoop):
         self.on_validate_start(trainer, model, val_dataloader, loop)
 
 
+def _log_softmax_normalizer(logits: torch.Tensor) -> torch.Tensor:
+    """Computes the float32 logsumexp over the last dimension of the logits.
+
+    The logits are only shifted and exponentiated in their own dtype, while
+    the sum and the final normalizer are computed in float32. This keeps
+    the accuracy of a float32 log softmax for bf16/fp16 logits without
+    making a float32 copy of them.
+
+    Args:
+        logits: Tensor of shape (..., vocab_size).
+
+    Returns:
+        Float32 tensor of shape (...).
+    """
+    max_logits = logits.amax(-1, keepdim=True)
+    sum_exp = torch.sum(
+        torch.exp(logits - max_logits), dim=-1, dtype=torch.float32
+    )
+    return sum_exp.log() + max_logits.squeeze(-1).float()
+
+
 class LogLikelihood(Callback):
     """
     Callback class to post-process model output logits to calculate
@@ -244,7 +382,13 @@ class LogLikelihood(Callback):
             token_lengths: List of tuples of (context_length, continuation_length)
                 for each sample in the batch.
         """
-        self.token_lengths = token_lengths
+        # Context and continuation lengths are kept as separate tensors so
+        # that a batch of them can be sliced and compared at once
+        self.ctx_lens, self.cont_lens = (
+            torch.tensor(token_lengths, dtype=torch.long)
+            .reshape(-1, 2)
+            .unbind(-1)
+        )
         self.sample_idx = 0
         self.results = []
 
@@ -259,41 +403,27 @@ class LogLikelihood(Callback):
         outputs.get("loss", None)
         lm_logits = outputs.get("logits")
 
-        # Calculate softmax of logits
-        lm_logits = torch.nn.functional.log_softmax(
-            lm_logits.float(), dim=-1, dtype=torch.float32
-        )
-
         # Post processing of output logits to produce
         # predictions and logits for continuation tokens
         attn_mask = batch["attention_mask"].to(torch.float32)
         cont_tokens = batch["continuation"].to(torch.long)
 
-        # Only keep logits corresponding to the continuation token positions
-        cont_logits = lm_logits.clone()
-        # Step 1: repeat attn_mask vocab_size times along the 2nd dim
-        # [bs, msl] -> [bs, msl, vocab_size]
-        attn_mask = attn_mask.unsqueeze(2).repeat(1, 1, cont_logits.shape[-1])
-
-        # Step 2: zero out the logits except the ones corresponding to continuation
-        # token positions
-        cont_logits = cont_logits * attn_mask
-
-        # Step 3: gather probs corresponding to the tokens in continuation
-        cont_toks_one_hot = one_hot(
-            cont_tokens, num_classes=lm_logits.shape[-1]
-        ).to(cont_logits.dtype)
-
-        cont_logits = cont_logits * cont_toks_one_hot
-        cont_log_probs = cont_logits.sum(-1)
+        # Log softmax is only needed at the continuation tokens, where it is
+        # the token logit minus the logsumexp over the vocab
+        log_norm = _log_softmax_normalizer(lm_logits)
+        cont_logits = (
+            lm_logits.gather(-1, cont_tokens.unsqueeze(-1)).squeeze(-1).float()
+        )
+        # Zero out the log probs outside of the continuation token positions
+        cont_log_probs = (cont_logits - log_norm) * attn_mask
 
-        predictions = lm_logits.argmax(-1).int()
-        # Subtract `cont_tokens` from `predictions` and output
-        # comparisons tensor to check if the continuation token
+        # Log softmax preserves the order of the logits
+        predictions = lm_logits.argmax(-1)
+        # Output a boolean tensor marking where the continuation token
         # predictions match the input
-        cont_comparisons = torch.add(predictions * -1, cont_tokens)
+        cont_matches = predictions == cont_tokens
 
-        self.post_process(trainer, cont_comparisons, cont_log_probs)
+        self.post_process(trainer, cont_matches, cont_log_probs)
 
     def on_eleuther_eval_harness_batch_end(
         self, trainer, model, outputs, batch, batch_idx
@@ -302,41 +432,52 @@ class LogLikelihood(Callback):
         self.progress.print(trainer, batch_idx)
 
     @cstorch.step_closure
-    def post_process(self, trainer, cont_comparisons, log_probs):
+    def post_process(self, trainer, cont_matches, log_probs):
         """
         Post-processes the model output logits to calculate log probabilities.
 
         Args:
             trainer: the Trainer object
-            cont_comparisons: Tensor of shape (batch_size, max_seq_len)
-                containing the comparison tensor for the continuation tokens
+            cont_matches: Boolean tensor of shape (batch_size, max_seq_len)
+                marking where the predictions match the continuation tokens
             log_probs: Tensor of shape (batch_size, max_seq_len)
                 containing the log probabilities for the continuation tokens
         """
         trainer.logger.debug(
-            f"Continuation Comparisons={cont_comparisons}, "
-            f"Logits={log_probs}, "
+            f"Continuation Matches={cont_matches}, Logits={log_probs}, "
         )
 
-        # Post processing of model output to produce results
-        for comparison, cont_logits in zip(cont_comparisons, log_probs):
-            tok_lengths = self.token_lengths[self.sample_idx]
-            ctx_len, cont_len = tok_lengths
-            if not ctx_len or not cont_len:
-                # Skip post processing for padded 0 tensors
-                continue
-
-            # Since we subtracted the model's predictions from the input
-            # tokens, predictions exactly match the continuation tokens
-            # where the `comparison` tensor has 0s
-            cont_comparison = comparison[ctx_len - 1 : ctx_len + cont_len - 1]
-            max_equal = (cont_comparison == 0).all()
-
-            # Answer: (log prob, is-exact-match)
-            answer = (float(cont_logits.sum()), bool(max_equal))
+        # Post processing of model output to produce results. Padded 0
+        # samples only appear after all of the real ones, so the batch is
+        # processed up to the first of them
+        batch_slice = slice(self.sample_idx, self.sample_idx + len(log_probs))
+        ctx_lens = self.ctx_lens[batch_slice]
+        cont_lens = self.cont_lens[batch_slice]
+        is_padded = (ctx_lens == 0) | (cont_lens == 0)
+        num_samples = (
+            int(is_padded.int().argmax()) if is_padded.any() else len(ctx_lens)
+        )
+        if not num_samples:
+            return
+        ctx_lens = ctx_lens[:num_samples]
+        cont_lens = cont_lens[:num_samples]
+
+        # The continuation is greedy if the predictions match at every
+        # continuation token position
+        positions = torch.arange(cont_matches.shape[-1])
+        cont_mask = (positions >= (ctx_lens - 1).unsqueeze(-1)) & (
+            positions < (ctx_lens + cont_lens - 1).unsqueeze(-1)
+        )
+        max_equal = (cont_matches[:num_samples] | ~cont_mask).all(-1)
 
-            self.results.append(answer)
-            self.sample_idx += 1
+        # Answer: (log prob, is-exact-match)
+        self.results.extend(
+            zip(
+                log_probs[:num_samples].sum(-1).tolist(),
+                max_equal.tolist(),
+            )
+        )
+        self.sample_idx += num_samples
 
 
 class GenerateUntil(Callback):
@@ -418,36 +559,69 @@ class GenerateUntil(Callback):
             predictions: Tensor of shape (batch_size, max_seq_len)
                 containing the model's predictions
         """
-        # Post processing of model output to produce results
-        for pred in predictions:
-            if not self.metadata[self.sample_idx]:
-                # Skip post processing for padded 0 tensors
-                continue
-            stop_words, ctx_len = self.metadata[self.sample_idx]
-
-            # Get tokens for the generated continuation string
-            gen_continuation = pred[ctx_len:].tolist()
-            try:
-                start_token_idx = gen_continuation.index(self.start_token)
-                gen_continuation = gen_continuation[:start_token_idx]
-            except ValueError:  # Generated string spans msl
-                pass
-
-            gen_continuation_str = self.tokenizer.decode(
-                gen_continuation,
-                skip_special_tokens=True,
+        # Post processing of model output to produce results. Padded 0
+        # samples only appear after all of the real ones, so the batch is
+        # processed up to the first of them
+        metadata = self.metadata[
+            self.sample_idx : self.sample_idx + len(predictions)
+        ]
+        num_samples = next(
+            (
+                i
+                for i, sample_metadata in enumerate(metadata)
+                if not sample_metadata
+            ),
+            len(metadata),
+        )
+        if not num_samples:
+            return
+        metadata = metadata[:num_samples]
+        predictions = predictions[:num_samples]
+
+        # The generated continuation ends at the first start token after the
+        # context, or spans msl if there is none. Find it for the whole batch
+        max_seq_len = predictions.shape[-1]
+        end_idxs = [max_seq_len] * num_samples
+        if isinstance(self.start_token, int):
+            ctx_lens = torch.tensor(
+                [ctx_len for _, ctx_len in metadata], dtype=torch.long
+            )
+            is_end = (predictions == self.start_token) & (
+                torch.arange(max_seq_len) >= ctx_lens.unsqueeze(-1)
             )
+            end_idxs = torch.where(
+                is_end.any(-1), is_end.int().argmax(-1), max_seq_len
+            ).tolist()
+
+        # Get tokens for the generated continuation strings and decode
+        # them all at once
+        gen_continuations = [
+            pred[ctx_len:end_idx].tolist()
+            for pred, (_, ctx_len), end_idx in zip(
+                predictions, metadata, end_idxs
+            )
+        ]
+        gen_continuation_strs = self.tokenizer.batch_decode(
+            gen_continuations,
+            skip_special_tokens=True,
+        )
 
-            # Use secondary stop seqs to cut off should-have-been-stopped content post-hoc
+        for (stop_words, _), gen_continuation_str in zip(
+            metadata, gen_continuation_strs
+        ):
+            # Use secondary stop seqs to cut off should-have-been-stopped content post-hoc.
+            # Each stop seq is only searched for within the text kept so far,
+            # so the string is sliced once at the end
+            cut_idx = len(gen_continuation_str)
             for stop_word in stop_words:
                 if (
                     len(stop_word) > 0
                 ):  # ignore '' separator, which is eos_id for some tokenizers
-                    gen_continuation_str = gen_continuation_str.split(
-                        stop_word
-                    )[0]
+                    stop_idx = gen_continuation_str.find(stop_word, 0, cut_idx)
+                    if stop_idx != -1:
+                        cut_idx = stop_idx
 
-            self.results.append(gen_continuation_str)
+            self.results.append(gen_continuation_str[:cut_idx])
             self.sample_idx += 1
 
 
@@ -527,8 +701,12 @@ class EleutherEvalHarness(ValidationCallback):
         self.name_scope = name_scope
 
     @cached_property
-    def has_generative_task(self):
-        """Returns True if the task dictionary contains a generative task."""
+    def _task_output_types(self) -> Tuple[bool, bool]:
+        """
+        Returns whether the task dictionary contains a generative task and
+        whether it contains a non-generative task, from a single pass over it.
+        """
+        has_generative_task = has_non_generative_task = False
         for task_obj in self.eh_runner.task_dict.items():
             if isinstance(task_obj, tuple):
                 _, task_obj = task_obj
@@ -536,23 +714,21 @@ class EleutherEvalHarness(ValidationCallback):
                     continue
 
             if task_obj.get_config("output_type") == "generate_until":
-                return True
+                has_generative_task = True
+            else:
+                has_non_generative_task = True
 
-        return False
+        return has_generative_task, has_non_generative_task
 
-    @cached_property
+    @property
+    def has_generative_task(self):
+        """Returns True if the task dictionary contains a generative task."""
+        return self._task_output_types[0]
+
+    @property
     def has_non_generative_task(self):
         """Returns True if the task dictionary contains a non-generative task."""
-        for task_obj in self.eh_runner.task_dict.items():
-            if isinstance(task_obj, tuple):
-                _, task_obj = task_obj
-                if task_obj is None:
-                    continue
-
-            if task_obj.get_config("output_type") != "generate_until":
-                return True
-
-        return False
+        return self._task_output_types[1]
 
     def run_validation(self, trainer, loop_idx, is_last):
         if not is_last and (loop_idx + 1) % self.every_n_vals != 0:
@@ -577,7 +753,9 @@ class EleutherEvalHarness(ValidationCallback):
         with self.scoped_flags:
             self.eh_runner.evaluate(
                 trainer=trainer,
-                model=EleutherLM(trainer, deepcopy(self.dataloader_args)),
+                # The adapter only pops and sets top-level keys, so a
+                # shallow copy keeps `self.dataloader_args` intact
+                model=EleutherLM(trainer, dict(self.dataloader_args)),
             )
 
 
@@ -0,0 +1,74 @@
+# Copyright 2022 Cerebras Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the EleutherAI Eval Harness callback helpers."""
+
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("cerebras.pytorch")
+pytest.importorskip("lm_eval")
+
+from cerebras.modelzoo.data.nlp.gpt.InferenceDataProcessor import (  # noqa: E402
+    InferenceDataProcessorLL,
+)
+from cerebras.modelzoo.trainer.extensions.eleuther.lm_eval_harness import (  # noqa: E402
+    _log_softmax_normalizer,
+    _rolling_windows,
+)
+
+
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float16])
+def test_log_softmax_normalizer_matches_float32(dtype):
+    generator = torch.Generator().manual_seed(0)
+    logits = (torch.randn(2, 16, 32000, generator=generator) * 4 + 10).to(dtype)
+
+    log_norm = _log_softmax_normalizer(logits)
+
+    assert log_norm.dtype == torch.float32
+    # Log probs of every token must match a float32 log softmax
+    log_probs = logits.float() - log_norm.unsqueeze(-1)
+    expected = torch.log_softmax(logits.float(), dim=-1)
+    torch.testing.assert_close(log_probs, expected, atol=5e-3, rtol=0)
+
+
+@pytest.mark.parametrize("num_tokens", [1, 7, 8, 9, 16, 17, 50])
+def test_rolling_windows_cover_all_tokens(num_tokens):
+    msl = 8
+    eos_token_id = 0
+    token_ids = list(range(100, 100 + num_tokens))
+
+    windows = _rolling_windows(token_ids, eos_token_id, msl)
+
+    assert len(windows) == math.ceil(num_tokens / msl)
+    # Every token is predicted exactly once, in order
+    assert [t for _, cont in windows for t in cont] == token_ids
+    assert windows[0][0] == [eos_token_id]
+
+    for window in windows:
+        sample, (ctx_len, cont_len, _) = (
+            InferenceDataProcessorLL._create_data_sample(
+                window, max_sequence_length=msl, tokenizer=None
+            )
+        )
+        input_ids, cont_ids, atten_mask, label_ids = sample
+        # Windows fill up to the whole msl without truncation
+        assert len(input_ids) == ctx_len + cont_len - 1 <= msl
+        assert (ctx_len, cont_len) == tuple(map(len, window))
+        mask = atten_mask.astype(bool)
+        assert cont_ids[mask].tolist() == window[1]
+        assert label_ids[mask].tolist() == window[1]
+        assert input_ids.tolist() == (window[0] + window[1])[:-1]